@@ -1,10 +1,12 @@
 import random
 
-def adj_by_drift(curr_genotypes_data, max_drift, N, K):
+def adj_by_drift(curr_genotypes_data, max_drift, N, K, rng=None):
     """
     Applies random genetic drift to the population, increasing or deceasing the genotype count up to max_drift.
     adj_drift is inversely relative to the population size with respect to carrying capacity.
 
+    If rng (a numpy Generator) is given, all noise is drawn from it in one call, otherwise from the global random module.
+
     """
     if K == 0:
         for data in curr_genotypes_data.values():
@@ -15,6 +17,15 @@ def adj_by_drift(curr_genotypes_data, max_drift, N, K):
 
 
     adj_drift = max_drift * (1 - (N / K))
+    if rng is not None:
+        # Scaled by hand rather than with rng.uniform, which rejects the swapped bounds of a cell over K (adj_drift < 0)
+        low, high = 1 - adj_drift, 1 + adj_drift
+        noise = low + (high - low) * rng.random((len(curr_genotypes_data), 2))
+        for data, (noise_m, noise_f) in zip(curr_genotypes_data.values(), noise.tolist()):
+            data['Nm'] = round(data['Nm'] * noise_m)
+            data['Nf'] = round(data['Nf'] * noise_f)
+        return curr_genotypes_data
+
     for data in curr_genotypes_data.values():
         data['Nm'] = round(data['Nm'] * random.uniform(1-adj_drift, 1+adj_drift))
         data['Nf'] = round(data['Nf'] * random.uniform(1-adj_drift, 1+adj_drift))
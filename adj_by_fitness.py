@@ -1,10 +1,12 @@
-def adj_by_fitness(curr_genotypes_data, topographical_fitnesses, x, y):
+def adj_by_fitness(curr_genotypes_data, topographical_fitnesses=None, x=None, y=None):
     """
-    Adjust genotype counts by their fitness.
+    Adjust genotype counts by their fitness, read from the topographical fitness maps at (x, y),
+    or from each genotype's 'fitness' if no maps are given (PopGen).
 
     """
     for genotype, data in curr_genotypes_data.items():
-        data['Nm'] = round(data['Nm'] * topographical_fitnesses[genotype][x][y])
-        data['Nf'] = round(data['Nf'] * topographical_fitnesses[genotype][x][y])
+        fitness = data['fitness'] if topographical_fitnesses is None else topographical_fitnesses[genotype][x][y]
+        data['Nm'] = round(data['Nm'] * fitness)
+        data['Nf'] = round(data['Nf'] * fitness)
     
     return curr_genotypes_data
\ No newline at end of file
@@ -1,34 +1,31 @@
-import random
+import numpy as np
+
+from generate_mutation_matrix import generate_mutation_matrix
 
 def adj_by_mutation(genotype_data, mutation_rate):
+    """
+    Each ordered pair of genotypes exchanges int(N * mutation_rate ** distance / (2G)) individuals of each sex,
+    clamped to the original counts of the source genotype, using the cached mutation matrix.
+
+    """
     mutated_data = {k: v.copy() for k, v in genotype_data.items()}
+    if mutation_rate is None:
+        return mutated_data
 
-    for genotype_a, data_a in genotype_data.items():
-        for genotype_b, data_b in genotype_data.items():
-            if genotype_a == genotype_b:
-                continue
-            distance = calc_distance(genotype_a, genotype_b)
-            mutation_prob = mutation_rate ** distance
-
-            total_individuals = data_a['Nm'] + data_a['Nf']
-            if total_individuals > 0:
-                N_mutations = int((total_individuals * mutation_prob) / (len(genotype_data) * 2))
-                
-                # Ensure mutations do not result in negative counts
-                N_mutations = min(N_mutations, data_a['Nm'])
-                N_mutations = min(N_mutations, data_a['Nf'])
-
-                mutated_data[genotype_a]['Nm'] -= N_mutations
-                mutated_data[genotype_a]['Nf'] -= N_mutations
-                mutated_data[genotype_b]['Nm'] += N_mutations
-                mutated_data[genotype_b]['Nf'] += N_mutations
+    M = generate_mutation_matrix(genotype_data.keys(), mutation_rate)
+    males = np.array([data['Nm'] for data in genotype_data.values()], dtype=float)
+    females = np.array([data['Nf'] for data in genotype_data.values()], dtype=float)
+    total_individuals = males + females
 
-    return mutated_data
+    N_mutations = np.trunc((total_individuals[:, None] * M) / (len(genotype_data) * 2))
 
-def calc_distance(genotype_a, genotype_b):
-    distance = 0
-    for locus in range(len(genotype_a)):
-        for allele in range(len(genotype_a[locus])):
-            if genotype_a[locus][allele] != genotype_b[locus][allele]:
-                distance += 1
-    return distance
+    # Ensure mutations do not result in negative counts
+    N_mutations = np.minimum(N_mutations, np.minimum(males, females)[:, None])
+    N_mutations[total_individuals <= 0] = 0
+
+    N_mutated = (N_mutations.sum(axis=0) - N_mutations.sum(axis=1)).astype(np.int64)
+    for data, N_mutated_genotype in zip(mutated_data.values(), N_mutated.tolist()):
+        data['Nm'] += N_mutated_genotype
+        data['Nf'] += N_mutated_genotype
+
+    return mutated_data
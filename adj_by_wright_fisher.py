@@ -0,0 +1,34 @@
+import numpy as np
+
+def adj_by_wright_fisher(curr_genotypes_data, K, rng=None):
+    """
+    Applies Wright-Fisher drift: redraws the N individuals of the population by multinomial sampling of the
+    genotype frequencies and splits each genotype's count into males and females by binomial sampling.
+    The strength of drift follows from N, so there is no max_drift. Populations with a carrying capacity of 0 are emptied.
+
+    rng is a numpy Generator, by default one seeded from np.random.
+
+    """
+    if rng is None:
+        rng = np.random.default_rng(np.random.randint(2**63, dtype=np.int64))
+
+    if K == 0:
+        for data in curr_genotypes_data.values():
+            data['Nm'] = 0
+            data['Nf'] = 0
+
+        return curr_genotypes_data
+
+    counts = np.array([data['Nm'] + data['Nf'] for data in curr_genotypes_data.values()], dtype=float)
+    N = counts.sum()
+    if N <= 0:
+        return curr_genotypes_data
+
+    counts = rng.multinomial(round(N), counts / N)
+    males = rng.binomial(counts, 0.5)
+
+    for data, count, Nm in zip(curr_genotypes_data.values(), counts.tolist(), males.tolist()):
+        data['Nm'] = Nm
+        data['Nf'] = count - Nm
+
+    return curr_genotypes_data
@@ -1,83 +1,234 @@
+import os
+
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import ListedColormap, Normalize
+
+from grid_history import GridHistory, CellHistoryView
+from genotype_registry import generate_genotype_registry
 
 class Animator:
-    def animate_gens_genotypes(self, genotypes, cells, width, height, generations):
+    def animate_history(self, path, genotypes=None, prevalence=False, gradient=True, output=None):
+        """
+        Animates a history file written by the vectorized engine, reading only the frames that are rendered.
+        If output is given, the animation is exported there instead of shown (see export_gens_genotypes).
+        """
+        history = GridHistory.open(path)
+        cells = history.generate_cells()
+        height, width = len(cells), len(cells[0])
+        recorded_generations = history.recorded_generations
+
+        if not genotypes:
+            genotypes = history.genotypes
+
+        if prevalence and output:
+            self.export_gens_genotype_prevalence(output, genotypes, cells, width, height, len(history), gradient, recorded_generations=recorded_generations)
+        elif prevalence:
+            self.animate_gens_genotype_prevalence(genotypes, cells, width, height, len(history), gradient, recorded_generations)
+        elif output:
+            self.export_gens_genotypes(output, genotypes, cells, width, height, len(history), recorded_generations=recorded_generations)
+        else:
+            self.animate_gens_genotypes(genotypes, cells, width, height, len(history), recorded_generations)
+
+    def animate_gens_genotypes(self, genotypes, cells, width, height, generations, recorded_generations=None):
 
         num_genotypes = len(genotypes)
-        fig, axs = plt.subplots(1, num_genotypes, figsize=(10 * num_genotypes, 10), sharex=True, sharey=True)
-        
-        if num_genotypes == 1:
-            axs = [axs]
+        fig = plt.figure(figsize=(10 * num_genotypes, 10))
+        update = self.draw_gens_genotypes(fig, genotypes, calc_gens_genotype_maps(genotypes, cells, generations, recorded_generations))
 
-        # Placeholder for the initial image
-        im = None
+        ani = animation.FuncAnimation(fig, update, frames=generations, interval=300, repeat=True)
 
-        def update(i):
-            nonlocal im
-            for idx, genotype in enumerate(genotypes):
-                map_data = [[None for _ in range(width)] for _ in range(height)]
-                for x in range(width):
-                    for y in range(height):
-                        cell = cells[y][x]
-                        N = cell.gens_genotype_data[i][genotype]['Nm'] + cell.gens_genotype_data[i][genotype]['Nf']
-                        percentage = N / cell.carrying_capacity if cell.carrying_capacity != 0 else 0
-                        map_data[y][x] = percentage
+        plt.show()
 
-                axs[idx].clear()
-                im = axs[idx].imshow(map_data, cmap='gray', origin='upper', vmin=0, vmax=1)
-                axs[idx].set_title(f'{genotype} at Generation {i}')
+    def export_gens_genotypes(self, path, genotypes, cells, width, height, generations, fps=4, dpi=100, recorded_generations=None):
+        """
+        Renders animate_gens_genotypes headlessly (Agg) to path: a .gif, .mp4 (requires ffmpeg),
+        or a .png name, which is numbered per frame (e.g. frames/gen.png becomes frames/gen_0000.png, ...).
+        """
+        num_genotypes = len(genotypes)
+        fig = Figure(figsize=(10 * num_genotypes, 10))
+        FigureCanvasAgg(fig)
+        update = self.draw_gens_genotypes(fig, genotypes, calc_gens_genotype_maps(genotypes, cells, generations, recorded_generations))
 
-            return [im] * num_genotypes
+        write_frames(fig, update, generations, path, fps, dpi)
 
-        ani = animation.FuncAnimation(fig, update, frames=generations, interval=300, repeat=True)
+    def draw_gens_genotypes(self, fig, genotypes, maps):
+        """
+        Draws the first frame of maps (see GenotypeMaps) on fig and returns a function that moves the images
+        to frame i by replacing their data, without clearing the axes. Titles show the generation each frame recorded.
+        """
+        num_genotypes = len(genotypes)
+        axs = fig.subplots(1, num_genotypes, sharex=True, sharey=True, squeeze=False)[0]
+
+        first = maps[0]
+        images = [ax.imshow(first[idx], cmap='gray', origin='upper', vmin=0, vmax=1) for idx, ax in enumerate(axs)]
+        titles = [ax.set_title(f'{genotype} at Generation {maps.recorded_generations[0]}') for ax, genotype in zip(axs, genotypes)]
 
-        dummy_plot = axs[0].imshow([[0]], cmap='gray', origin='upper', vmin=0, vmax=1)
         cbar_ax = fig.add_axes([0.92, 0.15, 0.02, 0.7])
-        cbar = plt.colorbar(dummy_plot, cax=cbar_ax)
+        cbar = fig.colorbar(images[0], cax=cbar_ax)
         cbar.set_label('Percentage')
 
-        plt.show()
-    
+        def update(i):
+            frame = maps[i]
+            for idx, genotype in enumerate(genotypes):
+                images[idx].set_data(frame[idx])
+                titles[idx].set_text(f'{genotype} at Generation {maps.recorded_generations[i]}')
+            return images + titles
 
-    def animate_gens_genotype_prevalence(self, genotypes, cells, width, height, generations, gradient):
+        return update
 
-        fig, ax = plt.subplots(figsize=(10, 10))
-        num_genotypes = len(genotypes)
-        colors = plt.cm.get_cmap('tab20', num_genotypes)
 
-        def update(i):
-            map_data = np.zeros((height, width), dtype=int)
-            for x in range(width):
-                for y in range(height):
-                    cell = cells[y][x]
-                    max_percentage = -1
-                    most_prevalent_genotype = None
-
-                    for genotype in genotypes:
-                        genotype_data = cell.gens_genotype_data[i].get(genotype, {'Nm': 0, 'Nf': 0})
-                        N = genotype_data['Nm'] + genotype_data['Nf']
-                        percentage = N / cell.carrying_capacity if cell.carrying_capacity != 0 else 0
-
-                        if percentage > max_percentage:
-                            max_percentage = percentage
-                            most_prevalent_genotype = genotype
-                    
-                    # Set the map data to the index of the most prevalent genotype
-                    if most_prevalent_genotype is not None:
-                        map_data[y, x] = genotypes.index(most_prevalent_genotype)
-            
-            ax.clear()
-            cax = ax.imshow(map_data, cmap=colors, origin='upper', vmin=0, vmax=num_genotypes-1)
-            ax.set_title(f'Most Prevalent Genotype at Generation {i}')
-            return cax,
+    def animate_gens_genotype_prevalence(self, genotypes, cells, width, height, generations, gradient, recorded_generations=None):
+
+        fig = plt.figure(figsize=(10, 10))
+        update = self.draw_gens_genotype_prevalence(fig, genotypes, calc_gens_genotype_maps(genotypes, cells, generations, recorded_generations), gradient)
 
         ani = animation.FuncAnimation(fig, update, frames=generations, interval=300, repeat=True)
-        
-        cbar = plt.colorbar(ax.imshow(np.zeros((1, 1)), cmap=colors, origin='upper', vmin=0, vmax=num_genotypes-1), ax=ax)
+
+        plt.show()
+
+    def export_gens_genotype_prevalence(self, path, genotypes, cells, width, height, generations, gradient, fps=4, dpi=100, recorded_generations=None):
+        """
+        Renders animate_gens_genotype_prevalence headlessly (Agg) to path, like export_gens_genotypes.
+        """
+        fig = Figure(figsize=(10, 10))
+        FigureCanvasAgg(fig)
+        update = self.draw_gens_genotype_prevalence(fig, genotypes, calc_gens_genotype_maps(genotypes, cells, generations, recorded_generations), gradient)
+
+        write_frames(fig, update, generations, path, fps, dpi)
+
+    def draw_gens_genotype_prevalence(self, fig, genotypes, maps, gradient):
+        """
+        Draws the first frame of the prevalence maps on fig and returns a function that moves the image to frame i.
+        Each cell shows the color of its most prevalent genotype, or if gradient, the colors of all its genotypes
+        blended by their frequencies.
+        """
+        num_genotypes = len(genotypes)
+        colors = ListedColormap(plt.get_cmap('tab20', num_genotypes)(np.arange(num_genotypes)))
+        ax = fig.subplots()
+
+        if gradient:
+            calc_frame = lambda i: calc_prevalence_gradient(maps[i], colors.colors[:, :3])
+            image = ax.imshow(calc_frame(0), origin='upper')
+            title = 'Genotypes'
+        else:
+            calc_frame = lambda i: calc_prevalence(maps[i])
+            image = ax.imshow(calc_frame(0), cmap=colors, origin='upper', vmin=0, vmax=num_genotypes-1)
+            title = 'Most Prevalent Genotype'
+        text = ax.set_title(f'{title} at Generation {maps.recorded_generations[0]}')
+
+        cbar = fig.colorbar(ScalarMappable(Normalize(-0.5, num_genotypes - 0.5), colors), ax=ax)
         cbar.set_ticks(np.arange(num_genotypes))
         cbar.set_ticklabels(genotypes)
         cbar.set_label('Genotype')
 
-        plt.show()
\ No newline at end of file
+        def update(i):
+            image.set_data(calc_frame(i))
+            text.set_text(f'{title} at Generation {maps.recorded_generations[i]}')
+            return image, text
+
+        return update
+
+
+def write_frames(fig, update, frames, path, fps=4, dpi=100):
+    """
+    Writes frames of an animation to a .gif, an .mp4 or a numbered .png sequence, calling update(i) before each frame.
+    """
+    root, extension = os.path.splitext(path)
+    extension = extension.lower()
+
+    if extension == '.png':
+        for i in range(frames):
+            update(i)
+            fig.savefig(f'{root}_{i:04d}.png', dpi=dpi)
+        return
+
+    if extension == '.gif':
+        writer = animation.PillowWriter(fps=fps)
+    elif extension == '.mp4':
+        writer = animation.FFMpegWriter(fps=fps)
+    else:
+        raise ValueError("Animations can be exported to .gif, .mp4 or .png files.")
+
+    with writer.saving(fig, path, dpi):
+        for i in range(frames):
+            update(i)
+            writer.grab_frame()
+
+
+def calc_genotype_counts(genotypes, cells, i):
+    """
+    The counts (Nm + Nf) of generation i, shaped (genotype, y, x).
+
+    Cells reading from a GridHistory are read in one slice of its array, other cells in a single pass over their data.
+    """
+    gens_genotype_data = cells[0][0].gens_genotype_data
+    if isinstance(gens_genotype_data, CellHistoryView):
+        history = gens_genotype_data.history
+        frame = np.asarray(history[i], dtype=float)
+        if frame.ndim == 5:
+            frame = frame[gens_genotype_data.replicate]
+
+        registry = generate_genotype_registry(history.genotypes)
+        return frame[[registry.id(genotype) for genotype in genotypes]].sum(axis=1)
+
+    empty = {'Nm': 0, 'Nf': 0}
+    return np.array([
+        [[cell.gens_genotype_data[i].get(genotype, empty)['Nm'] + cell.gens_genotype_data[i].get(genotype, empty)['Nf'] for cell in row] for row in cells]
+        for genotype in genotypes
+    ], dtype=float).reshape(len(genotypes), len(cells), len(cells[0]))
+
+
+class GenotypeMaps:
+    """
+    The count of each genotype as a share of the carrying capacity of its cell, 0 where K is 0, for the first
+    generations. Indexing a generation computes its (genotype, y, x) map, so a history is read one frame at a time
+    and never has to fit in memory.
+
+    recorded_generations gives the generation number of each frame, for histories recording only every k-th
+    generation; by default frame i is generation i.
+    """
+    def __init__(self, genotypes, cells, generations, recorded_generations=None):
+        self.genotypes = genotypes
+        self.cells = cells
+        self.generations = generations
+        self.recorded_generations = np.arange(generations) if recorded_generations is None else recorded_generations
+        self.carrying_capacity = np.array([[cell.carrying_capacity for cell in row] for row in cells], dtype=float)
+
+    def __len__(self):
+        return self.generations
+
+    def __getitem__(self, i):
+        counts = calc_genotype_counts(self.genotypes, self.cells, i)
+        K = self.carrying_capacity
+        return np.where(K == 0, 0, counts / np.where(K == 0, 1, K))
+
+
+def calc_gens_genotype_maps(genotypes, cells, generations, recorded_generations=None):
+    """
+    The genotype maps of the first generations, computed when each frame is drawn (see GenotypeMaps).
+    """
+    return GenotypeMaps(genotypes, cells, generations, recorded_generations)
+
+
+def calc_prevalence(genotype_map):
+    """
+    The index of the most prevalent genotype of every cell, shaped (..., y, x), from (..., genotype, y, x) maps.
+    Ties go to the first genotype.
+    """
+    return genotype_map.argmax(axis=-3)
+
+
+def calc_prevalence_gradient(genotype_map, palette):
+    """
+    The colors of every cell's genotypes blended by their frequencies, shaped (..., y, x, channel), as one matrix product
+    of the (..., genotype, y, x) maps with a (genotype, channel) palette. Empty cells are black.
+    """
+    total = genotype_map.sum(axis=-3, keepdims=True)
+    frequencies = genotype_map / np.where(total == 0, 1, total)
+
+    return np.clip(np.einsum('...gyx,gc->...yxc', frequencies, palette), 0, 1)
@@ -1,4 +1,41 @@
-def append_gene_flow_cells(cells, topographical_gene_flow_distance):
+import numpy as np
+
+from grid_engine import NM, NF, cells_to_grid, calc_gene_flow_grid
+
+def append_gene_flow_cells(cells, topographical_gene_flow_distance, convolve=True):
+    """
+    Appends the next generation to each cell after moving the overflow above carrying capacity to nearby cells.
+
+    By default the gene flow is computed over the whole map with convolutions (see calc_gene_flow_grid).
+    With convolve=False it loops over every cell's neighbourhood instead, which is kept as the reference.
+
+    """
+    if not convolve:
+        return append_gene_flow_cells_loop(cells, topographical_gene_flow_distance)
+
+    genotypes = cells[0][0].genotypes
+    grid, _ = cells_to_grid(cells, genotypes)
+    K = np.array([[cell.carrying_capacity for cell in row] for row in cells])
+    distances = np.stack([topographical_gene_flow_distance[genotype].map_data.T for genotype in genotypes])
+
+    grid = calc_gene_flow_grid(grid, K, distances)
+
+    for x in range(len(cells)):
+        for y in range(len(cells[0])):
+            genotype_data = {
+                genotype: {
+                    'Nm': grid[g, NM, x, y].item(),
+                    'Nf': grid[g, NF, x, y].item(),
+                    'covariance': cells[x][y].gens_genotype_data[0][genotype]['covariance'],
+                }
+                for g, genotype in enumerate(genotypes)
+            }
+            cells[x][y].gens_genotype_data.append(genotype_data)
+
+    return cells
+
+
+def append_gene_flow_cells_loop(cells, topographical_gene_flow_distance):
     def update_gene_flow(x, y, Nm_or_Nf, new_N, rate, max_distance):
         if rate > 0 and Nm_or_Nf > 0 and max_distance > 0:
             for i in range(max(0, x-max_distance), min(len(cells), x+max_distance+1)):
@@ -48,5 +85,7 @@ def append_gene_flow_cells(cells, topographical_gene_flow_distance):
 def append_cells(cells):
     for x in range(len(cells)):
         for y in range(len(cells[0])):
-            cells[x][y].gens_genotype_data.append(cells[x][y].gens_genotype_data[-1])
+            # Copy so that updating the new generation in place leaves the previous one intact
+            genotype_data = {genotype: data.copy() for genotype, data in cells[x][y].gens_genotype_data[-1].items()}
+            cells[x][y].gens_genotype_data.append(genotype_data)
     return cells
\ No newline at end of file
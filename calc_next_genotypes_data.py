@@ -1,52 +1,95 @@
-from generate_punnett_square import generate_punnett_square
+import numpy as np
+
+from generate_transmission_tensor import generate_transmission_tensor, generate_locus_transmission_tensors
 from calc_N import calc_N
 
-def calc_next_genotypes_data(curr_genotypes_data, next_N):
+def calc_next_genotypes_data(curr_genotypes_data, next_N, factorized=False):
+    """
+    Calculates the genotype counts of the next generation by random mating, scaled to next_N.
+
+    If factorized, offspring are built locus by locus (see calc_factorized_offspring), so time and memory
+    grow linearly in the number of loci. This requires zero covariance.
+
+    """
     N = calc_N(curr_genotypes_data)
 
     if N == 0:
         return curr_genotypes_data
 
-    # Initialize next generation genotype data with 0 for Nm and Nf
-    next_genotypes_data = {}
-    for genotype, data in curr_genotypes_data.items():
-        next_genotypes_data[genotype] = {'Nm': 0, 'Nf': 0, 'covariance': data['covariance']}
-
-    # Iterate over all pairs of parent genotypes
-    for genotype_A, data_A in curr_genotypes_data.items():
-        for genotype_B, data_B in curr_genotypes_data.items():
-            # Generate Punnett square for the parent pair
-            punnett_square = generate_punnett_square(genotype_A, genotype_B)
-            
-            # Calculate the total number of matings between genotype_A and genotype_B
-            matings_AB = data_A['Nm'] * data_B['Nf']
-            matings_BA = data_B['Nm'] * data_A['Nf']
-            
-            # Apply the covariance factor
-            covariance_effect = (data_A['covariance'] + data_B['covariance']) / 2
-            if genotype_A == genotype_B:
-                total_matings = (matings_AB + matings_BA) / N * (1 + covariance_effect)
-            else:
-                total_matings = (matings_AB + matings_BA) / N * (1 - covariance_effect)
-
-            # Distribute offspring based on Punnett square frequencies
-            for genotype, frequency in punnett_square.items():
-                offspring_count = total_matings * frequency
-                next_genotypes_data[genotype]['Nm'] += offspring_count / 2
-                next_genotypes_data[genotype]['Nf'] += offspring_count / 2
+    genotypes = list(curr_genotypes_data.keys())
+    males = np.array([data['Nm'] for data in curr_genotypes_data.values()], dtype=float)
+    females = np.array([data['Nf'] for data in curr_genotypes_data.values()], dtype=float)
+    covariances = np.array([data['covariance'] for data in curr_genotypes_data.values()], dtype=float)
+
+    if factorized:
+        if covariances.any():
+            raise ValueError("Factorized mating requires zero covariance.")
+        offspring = calc_factorized_offspring(males[:, None, None], females[:, None, None], genotypes)[:, 0, 0]
+    else:
+        offspring = calc_offspring(males, females, covariances, genotypes, N)
 
     # Normalize the frequencies to ensure they add up to 1
-    total_frequency = sum([data['Nm'] + data['Nf'] for data in next_genotypes_data.values()])
+    total_frequency = offspring.sum()
     if total_frequency == 0:
-        return next_genotypes_data
-    
-    for genotype, data in next_genotypes_data.items():
-        data['Nm'] /= total_frequency
-        data['Nf'] /= total_frequency
+        return {genotype: {**data, 'Nm': 0, 'Nf': 0} for genotype, data in curr_genotypes_data.items()}
 
-    # Turn the frequencies back into counts, applying the growth rate
-    for genotype, data in next_genotypes_data.items():
-        data['Nm'] = round(data['Nm'] * next_N)
-        data['Nf'] = round(data['Nf'] * next_N)
+    # Turn the frequencies back into counts, applying the growth rate, and keep other properties such as fitness
+    next_genotypes_data = {}
+    for genotype, frequency, data in zip(genotypes, offspring / 2 / total_frequency, curr_genotypes_data.values()):
+        count = round(frequency.item() * next_N)
+        next_genotypes_data[genotype] = {**data, 'Nm': count, 'Nf': count}
 
     return next_genotypes_data
+
+def calc_offspring(males, females, covariances, genotypes, N):
+    """
+    Calculates the offspring count of each genotype from the male and female counts through the transmission tensor.
+
+    """
+    # Calculate the total number of matings between each ordered pair of parent genotypes (A male x B female and B male x A female)
+    matings = np.outer(males, females)
+    matings = (matings + matings.T) / N
+
+    # Apply the covariance factor
+    if covariances.any():
+        covariance_effect = (covariances[:, None] + covariances[None, :]) / 2
+        matings *= np.where(np.eye(len(genotypes), dtype=bool), 1 + covariance_effect, 1 - covariance_effect)
+
+    # Distribute offspring based on the Punnett square frequencies in the transmission tensor
+    return np.einsum('ab,abc->c', matings, generate_transmission_tensor(genotypes))
+
+def calc_factorized_offspring(males, females, genotypes):
+    """
+    Calculates offspring genotype frequencies as the product of independent per-locus mating outcomes.
+
+    Male and female counts are reduced to single-locus genotype frequencies, mated through each locus's
+    transmission tensor and recombined with a Kronecker product. This is exact for independently segregating
+    loci whose parents are in linkage equilibrium, and otherwise approximates the full mating.
+
+    Args:
+    - males, females: Arrays of counts shaped (..., G, height, width).
+    - genotypes: List of genotypes in the order of the G axis.
+
+    Returns:
+    - Offspring frequencies shaped (..., G, height, width), summing to 1 where both sexes are present and 0 elsewhere.
+    """
+    locus_indices, tensors = generate_locus_transmission_tensors(genotypes)
+
+    offspring = np.ones(males.shape)
+    for indices, T in zip(locus_indices, tensors):
+        locus_males = _sum_by_locus_genotype(males, indices, len(T))
+        locus_females = _sum_by_locus_genotype(females, indices, len(T))
+
+        locus_offspring = np.einsum('...ahw,...bhw,abc->...chw', locus_males, locus_females, T, optimize=True)
+        total = locus_offspring.sum(axis=-3, keepdims=True)
+        locus_offspring = locus_offspring / np.where(total == 0, 1, total)
+
+        offspring *= locus_offspring[..., indices, :, :]
+
+    return offspring
+
+def _sum_by_locus_genotype(counts, indices, num_locus_genotypes):
+    locus_counts = np.zeros(counts.shape[:-3] + (num_locus_genotypes,) + counts.shape[-2:])
+    for locus_genotype in range(num_locus_genotypes):
+        locus_counts[..., locus_genotype, :, :] = counts[..., indices == locus_genotype, :, :].sum(axis=-3)
+    return locus_counts
@@ -1,28 +1,29 @@
-import random
-from collections import defaultdict
+import numpy as np
+
+from genotype_registry import generate_genotype_registry
 
 class Cell:
-    def __init__(self, x, y, Nm, Nf, genotypes, carrying_capacity):
+    def __init__(self, x, y, Nm, Nf, genotypes, carrying_capacity, rng=None):
         self.x = x
         self.y = y
         self.Nm = Nm
         self.Nf = Nf
         self.genotypes = genotypes
+        self.registry = generate_genotype_registry(genotypes)
         self.carrying_capacity = carrying_capacity
+        self.rng = rng if rng is not None else np.random
 
         self.gens_genotype_data = [self.generate_genotype_data()]
         
     def generate_genotype_data(self, covariance_avg=None, covariance_std=None):
 
-        genotype_data = defaultdict(lambda: {
-            'Nm':  self.Nm // len(self.genotypes), 
-            'Nf':  self.Nf // len(self.genotypes), 
-            'covariance': random.gauss(covariance_avg, covariance_std) if covariance_avg and covariance_std else 0
-        })
-
-        for genotype in self.genotypes:
-            sorted_genotype = tuple(tuple(sorted(pair)) for pair in genotype)
-            genotype_data[sorted_genotype]
-
-        return dict(genotype_data)
+        # The registry holds the genotypes sorted and without duplicates
+        return {
+            genotype: {
+                'Nm':  self.Nm // len(self.genotypes), 
+                'Nf':  self.Nf // len(self.genotypes), 
+                'covariance': self.rng.normal(covariance_avg, covariance_std) if covariance_avg and covariance_std else 0
+            }
+            for genotype in self.registry
+        }
     
@@ -0,0 +1,141 @@
+import os
+import json
+import random
+
+import numpy as np
+
+from topographical_map import TopographicMap
+from rng import RandomStreams
+from genotype_registry import generate_genotype_registry
+from statistics_collector import StatisticsCollector
+from grid_history import GridHistory, genotypes_from_array
+
+# TopographicalSpeciation settings that are restored from a checkpoint
+CHECKPOINT_ATTRIBUTES = [
+    'width', 'height', 'N', 'K', 'min_cell_K',
+    'smoothness', 'loci', 'alleles', 'landscape_seed', 'field_cache_dir',
+    'growth_rate', 'max_drift', 'drift_mode', 'max_gene_flow_distance', 'mutation_rate',
+    'factorized_mating', 'generations', 'replicates',
+    'stop_early', 'convergence_tolerance', 'convergence_patience', 'stop_on_fixation',
+    'vectorized', 'sparse_gene_flow', 'fused_kernel', 'history_path', 'history_stride',
+    'checkpoint_path', 'checkpoint_every',
+    'workers', 'tile_rows',
+]
+
+def write_checkpoint(ts, path, generation, generations, bottleneck_yr=None, bottleneck_N=None):
+    """
+    Writes everything needed to continue a vectorized TopographicalSpeciation run bit-identically to a single .npz file:
+    settings, topographical maps, genotypes, the current grid, the history, the random states and the next generation.
+
+    The file is written next to path first and then moved into place, so an interrupted write never
+    corrupts the previous checkpoint.
+
+    """
+    if not ts.vectorized:
+        raise ValueError("Checkpoints require the vectorized engine.")
+
+    settings = {attribute: getattr(ts, attribute) for attribute in CHECKPOINT_ATTRIBUTES}
+    settings['history_dtype'] = np.dtype(ts.history_dtype).name
+    settings['seed'] = ts.streams.seed
+    settings['run'] = {'generation': generation, 'generations': generations, 'bottleneck_yr': bottleneck_yr, 'bottleneck_N': bottleneck_N}
+
+    ts.history.flush()
+    history_frames = ts.history[:] if ts.history.path is None else np.zeros((0,))
+
+    statistics = {f'statistics_{name}': array for name, array in ts.statistics.to_arrays().items()}
+    if ts.convergence is not None:
+        statistics.update({f'convergence_{name}': array for name, array in ts.convergence.to_arrays().items()})
+
+    python_state = random.getstate()
+    numpy_state = np.random.get_state()
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f,
+                 settings=np.array(json.dumps(settings, default=lambda o: o.item())),
+                 genotypes=np.array(ts.genotypes),
+                 carrying_capacity=ts.topographical_carrying_capacity.map_data,
+                 fitnesses=np.stack([ts.topographical_fitnesses[genotype].map_data for genotype in ts.genotypes]),
+                 gene_flow_distances=np.stack([ts.topographical_gene_flow_distance[genotype].map_data for genotype in ts.genotypes]),
+                 grid=ts.grid,
+                 covariances=ts.grid_covariances,
+                 history_frames=history_frames,
+                 history_generations_seen=ts.history.generations_seen,
+                 python_random_state=np.array(python_state[1], dtype=np.uint64),
+                 python_random_gauss=np.nan if python_state[2] is None else python_state[2],
+                 numpy_random_keys=numpy_state[1],
+                 numpy_random_position=np.array(numpy_state[2:4]),
+                 numpy_random_gauss=numpy_state[4],
+                 **statistics)
+    os.replace(tmp_path, path)
+
+def read_checkpoint(ts, path):
+    """
+    Restores a TopographicalSpeciation from a checkpoint written by write_checkpoint.
+
+    Returns:
+    - The next generation, the run's total generations, bottleneck_yr and bottleneck_N.
+    """
+    with np.load(path) as checkpoint:
+        settings = json.loads(checkpoint['settings'].item())
+        for attribute in CHECKPOINT_ATTRIBUTES:
+            setattr(ts, attribute, settings[attribute])
+        ts.history_dtype = np.dtype(settings['history_dtype'])
+        ts.streams = RandomStreams(settings['seed'])
+
+        ts.genotypes = genotypes_from_array(checkpoint['genotypes'])
+        ts.registry = generate_genotype_registry(ts.genotypes)
+        ts.topographical_carrying_capacity = TopographicMap(ts.width,
+                                                            ts.height,
+                                                            'Carrying Capacity',
+                                                            ts.smoothness,
+                                                            min_val=ts.min_cell_K,
+                                                            sum_val=ts.K,
+                                                            map_data=checkpoint['carrying_capacity'])
+        ts.topographical_fitnesses = {
+            genotype: TopographicMap(ts.width, ts.height, genotype, ts.smoothness, map_data=map_data)
+            for genotype, map_data in zip(ts.genotypes, checkpoint['fitnesses'])
+        }
+        ts.topographical_gene_flow_distance = {
+            genotype: TopographicMap(ts.width, ts.height, genotype, ts.smoothness, max_val=ts.max_gene_flow_distance, map_data=map_data)
+            for genotype, map_data in zip(ts.genotypes, checkpoint['gene_flow_distances'])
+        }
+
+        ts.cells = ts.generate_cells()
+        ts.generate_grid_fields()
+        ts.grid = checkpoint['grid']
+        ts.grid_covariances = checkpoint['covariances']
+
+        run = settings['run']
+        generations_seen = int(checkpoint['history_generations_seen'])
+        capacity = -(-(run['generations'] + 1) // ts.history_stride)
+        if ts.history_path is None:
+            ts.history = GridHistory.from_frames(checkpoint['history_frames'],
+                                                 ts.genotypes,
+                                                 ts.grid_covariances,
+                                                 ts.grid_carrying_capacity,
+                                                 capacity=capacity,
+                                                 stride=ts.history_stride,
+                                                 generations_seen=generations_seen)
+        else:
+            ts.history = GridHistory.open(ts.history_path, mode='r+')
+            ts.history.rewind(generations_seen)
+            ts.history.reserve(capacity)
+        ts.attach_history()
+
+        ts.statistics = StatisticsCollector.from_arrays(ts.registry, {
+            name[len('statistics_'):]: checkpoint[name] for name in checkpoint.files if name.startswith('statistics_')
+        })
+
+        ts.convergence = ts.generate_convergence_detector()
+        if ts.convergence is not None:
+            ts.convergence.restore_arrays({
+                name[len('convergence_'):]: checkpoint[name] for name in checkpoint.files if name.startswith('convergence_')
+            })
+
+        python_gauss = checkpoint['python_random_gauss'].item()
+        random.setstate((3, tuple(int(n) for n in checkpoint['python_random_state']), None if np.isnan(python_gauss) else python_gauss))
+        position, has_gauss = (int(n) for n in checkpoint['numpy_random_position'])
+        np.random.set_state(('MT19937', checkpoint['numpy_random_keys'], position, has_gauss, checkpoint['numpy_random_gauss'].item()))
+
+    return run['generation'], run['generations'], run['bottleneck_yr'], run['bottleneck_N']
@@ -0,0 +1,81 @@
+import numpy as np
+
+from genotype_registry import generate_genotype_registry
+
+# Reasons a run can stop early, in the order they're checked
+STOP_REASONS = ['extinction', 'fixation', 'equilibrium']
+
+class ConvergenceDetector:
+    """
+    Detects when a run has stopped changing, so it can end early.
+
+    After each generation, update checks, in order, for:
+    - 'extinction': no individuals are left.
+    - 'fixation': every locus has a single allele left in the whole population, or the population is extinct.
+      With mutation, alleles can come back, so set fixation to False to wait for equilibrium instead.
+    - 'equilibrium': the genotype frequencies of no cell have changed by more than tolerance for patience
+      generations in a row.
+
+    Counts may carry leading axes (e.g. replicates), in which case every replicate must have stopped changing.
+
+    """
+    def __init__(self, genotypes, tolerance=1e-4, patience=10, fixation=True):
+        self.registry = generate_genotype_registry(genotypes)
+        self.tolerance = tolerance
+        self.patience = patience
+        self.fixation = fixation
+
+        # One-hot (allele, locus) matrix, to count the alleles left at each locus
+        num_loci = self.registry.allele_loci.max(initial=0) + 1
+        self.loci = np.eye(num_loci)[self.registry.allele_loci]
+
+        self.previous = None
+        self.stable_generations = 0
+        self.reason = None
+
+    def update(self, grid):
+        """
+        Records one generation of counts shaped (..., genotype, sex, height, width) and returns the reason
+        the run has converged (see STOP_REASONS), or None if it hasn't.
+        """
+        genotype_N = np.asarray(grid, dtype=float).sum(axis=-3)
+        N = genotype_N.sum(axis=-3)
+        frequencies = genotype_N / np.where(N == 0, 1, N)[..., None, :, :]
+
+        if self.previous is not None and np.abs(frequencies - self.previous).max(initial=0) <= self.tolerance:
+            self.stable_generations += 1
+        else:
+            self.stable_generations = 0
+        self.previous = frequencies
+
+        # Alleles left at each locus of each replicate, pooled over the map
+        alleles_left = ((genotype_N.sum(axis=(-2, -1)) @ self.registry.allele_counts) > 0) @ self.loci
+        extinct = (alleles_left == 0).all(axis=-1)
+        fixed = (alleles_left == 1).all(axis=-1)
+
+        if extinct.all():
+            self.reason = 'extinction'
+        elif self.fixation and (fixed | extinct).all():
+            self.reason = 'fixation'
+        elif self.stable_generations >= self.patience:
+            self.reason = 'equilibrium'
+        else:
+            self.reason = None
+
+        return self.reason
+
+    def to_arrays(self):
+        """
+        The detector's state, e.g. for a checkpoint.
+        """
+        return {
+            'previous': np.zeros((0,)) if self.previous is None else self.previous,
+            'stable_generations': np.asarray(self.stable_generations),
+        }
+
+    def restore_arrays(self, arrays):
+        """
+        Restores the state from to_arrays.
+        """
+        self.previous = arrays['previous'] if arrays['previous'].size else None
+        self.stable_generations = int(arrays['stable_generations'])
@@ -0,0 +1,76 @@
+import numpy as np
+from scipy import sparse
+
+from grid_engine import calc_N_grid
+
+def generate_dispersal_operators(distances):
+    """
+    Generates one sparse dispersal operator per genotype from its gene flow distance map, shaped (genotype, height, width).
+
+    Column src of operator P holds the weights with which one emigrating individual from cell src lands in
+    every cell within its integer gene flow distance (1 / Manhattan distance), minus 1 on the diagonal for
+    leaving home. Cells that don't flow have empty columns. Cells are flattened in row-major (y, x) order.
+
+    The operators only depend on the distance maps, so they are built once and reused every generation.
+
+    """
+    height, width = distances.shape[-2:]
+    cell_indices = np.arange(height * width).reshape(height, width)
+    max_distances = distances.astype(int)
+
+    operators = []
+    for genotype_distances in max_distances:
+        rows, cols, weights = [], [], []
+
+        flowing = genotype_distances > 0
+        rows.append(cell_indices[flowing])
+        cols.append(cell_indices[flowing])
+        weights.append(-np.ones(np.count_nonzero(flowing)))
+
+        max_distance = int(genotype_distances.max(initial=0))
+        for di in range(-max_distance, max_distance + 1):
+            for dj in range(-max_distance, max_distance + 1):
+                if di == 0 and dj == 0:
+                    continue
+                reach = genotype_distances[max(0, -di):min(height, height - di), max(0, -dj):min(width, width - dj)] >= max(abs(di), abs(dj))
+                src = cell_indices[max(0, -di):min(height, height - di), max(0, -dj):min(width, width - dj)][reach]
+                dst = cell_indices[max(0, di):min(height, height + di), max(0, dj):min(width, width + dj)][reach]
+
+                rows.append(dst)
+                cols.append(src)
+                weights.append(np.full(len(src), 1 / (abs(di) + abs(dj))))
+
+        operator = sparse.coo_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+                                     shape=(height * width, height * width))
+        operators.append(operator.tocsr())
+
+    return operators
+
+def calc_dispersal_nonzeros(distances):
+    """
+    An upper bound on the nonzeros of the operators generate_dispersal_operators would build from distances:
+    (2d + 1)^2 per flowing cell of each genotype, ignoring the map edges.
+
+    """
+    max_distances = distances.astype(int)
+    return int(np.where(max_distances > 0, (2 * max_distances + 1) ** 2, 0).sum())
+
+def calc_gene_flow_sparse(grid, K, operators):
+    """
+    Sparse calc_gene_flow_grid. Each generation's migration is one sparse matrix product per genotype
+    of its dispersal operator with the emigrants, i.e. counts scaled by the per-cell overflow rate (N - K) / N.
+
+    """
+    N = calc_N_grid(grid)
+    safe_N = np.where(N == 0, 1, N)
+    rate = np.where((N > K) & (N > 0), (N - K) / safe_N, 0)[..., None, None, :, :]
+
+    emigrants = np.where(grid > 0, rate * grid, 0)
+
+    new_grid = grid.copy()
+    for g, operator in enumerate(operators):
+        genotype_emigrants = emigrants[..., g, :, :, :]
+        columns = genotype_emigrants.reshape(-1, operator.shape[0]).T
+        new_grid[..., g, :, :, :] += (operator @ columns).T.reshape(genotype_emigrants.shape)
+
+    return new_grid
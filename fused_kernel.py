@@ -0,0 +1,173 @@
+import numpy as np
+
+from grid_engine import calc_next_grid
+from generate_transmission_tensor import generate_transmission_tensor
+from generate_mutation_matrix import generate_mutation_matrix
+from stage_timer import NULL_TIMER
+
+# Numba is an optional extra. Without it calc_next_grid_fused runs the NumPy engine instead,
+# and _fused_generation stays plain Python, which is only useful for checking it on small grids.
+try:
+    from numba import njit, prange, get_num_threads
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    prange = range
+
+    def get_num_threads():
+        return 1
+
+    def njit(*args, **kwargs):
+        return lambda function: function
+
+
+def calc_next_grid_fused(grid, K, fitnesses, covariances, genotypes, growth_rate, max_drift, mutation_rate,
+                         bottleneck_N=None, factorized=False, rng=np.random, drift_mode='uniform', out=None, timer=NULL_TIMER):
+    """
+    calc_next_grid as a single compiled pass over the cells, parallel across cores with Numba.
+
+    Each cell runs growth, fitness, drift, the bottleneck, mating and mutation in registers and small scratch
+    arrays and writes its counts into out, which can be passed back in every generation to avoid allocating
+    a new grid (it must not be the input grid). Drift noise is drawn from rng in bulk beforehand, in the same
+    order as calc_next_grid, so both give the same counts up to the summation order of the mating.
+
+    Falls back to calc_next_grid if Numba isn't installed, and for factorized mating or Wright-Fisher drift.
+    The pass can't be split into steps, so timer records it as a single 'fused' stage.
+
+    """
+    if not NUMBA_AVAILABLE or factorized or drift_mode != 'uniform':
+        return calc_next_grid(grid, K, fitnesses, covariances, genotypes, growth_rate, max_drift, mutation_rate,
+                              bottleneck_N, factorized, rng, drift_mode, timer)
+
+    with timer.stage('fused'):
+        return _calc_next_grid_fused(grid, K, fitnesses, covariances, genotypes, growth_rate, max_drift, mutation_rate,
+                                     bottleneck_N, rng, out)
+
+
+def _calc_next_grid_fused(grid, K, fitnesses, covariances, genotypes, growth_rate, max_drift, mutation_rate,
+                          bottleneck_N, rng, out):
+    if out is None or out.shape != grid.shape or not out.flags.c_contiguous:
+        out = np.empty(grid.shape)
+
+    drift_noise = rng.uniform(np.zeros(grid.shape), np.ones(grid.shape))
+    bottleneck_noise = drift_noise if bottleneck_N is None else rng.uniform(np.zeros(grid.shape), np.ones(grid.shape))
+
+    # Males, females and offspring of the cell each thread is on, allocated once per generation rather than per cell
+    scratch = np.empty((get_num_threads(), 3, len(genotypes)))
+
+    cells = (-1,) + grid.shape[-4:]
+    _fused_generation(np.ascontiguousarray(grid, dtype=float).reshape(cells),
+                      np.ascontiguousarray(K, dtype=float),
+                      np.ascontiguousarray(fitnesses, dtype=float),
+                      np.ascontiguousarray(covariances, dtype=float),
+                      generate_transmission_tensor(genotypes),
+                      np.zeros((len(genotypes), len(genotypes))) if mutation_rate is None else generate_mutation_matrix(genotypes, mutation_rate),
+                      float(growth_rate),
+                      float(max_drift),
+                      mutation_rate is not None,
+                      bottleneck_N is not None,
+                      0.0 if bottleneck_N is None else float(bottleneck_N),
+                      drift_noise.reshape(cells),
+                      bottleneck_noise.reshape(cells),
+                      out.reshape(cells),
+                      scratch)
+    return out
+
+
+@njit(parallel=True, cache=True)
+def _fused_generation(grid, K, fitnesses, covariances, T, mutation_probabilities, growth_rate, max_drift,
+                      mutate, bottleneck, bottleneck_N, drift_noise, bottleneck_noise, out, scratch):
+    replicates, num_genotypes, _, height, width = grid.shape
+    num_cells = replicates * height * width
+    threads = scratch.shape[0]
+    chunk = -(-num_cells // threads)
+
+    # One contiguous chunk of cells per thread, so each thread reuses its own scratch arrays
+    for thread in prange(threads):
+        males = scratch[thread, 0]
+        females = scratch[thread, 1]
+        offspring = scratch[thread, 2]
+
+        for cell in range(thread * chunk, min(num_cells, (thread + 1) * chunk)):
+            r = cell // (height * width)
+            y = (cell // width) % height
+            x = cell % width
+
+            for g in range(num_genotypes):
+                offspring[g] = 0.0
+
+            # Logistic growth
+            N = 0.0
+            for g in range(num_genotypes):
+                N += grid[r, g, 0, y, x] + grid[r, g, 1, y, x]
+            cell_K = K[y, x]
+            if cell_K == 0:
+                next_N = N + N * growth_rate
+            else:
+                next_N = N + growth_rate * N * (1 - (N / cell_K))
+            next_N = max(1.0, next_N)
+            safe_K = 1.0 if cell_K == 0 else cell_K
+
+            # Fitness
+            N = 0.0
+            for g in range(num_genotypes):
+                males[g] = np.rint(grid[r, g, 0, y, x] * fitnesses[g, y, x])
+                females[g] = np.rint(grid[r, g, 1, y, x] * fitnesses[g, y, x])
+                N += males[g] + females[g]
+
+            # Drift
+            adj_drift = max_drift * (1 - (N / safe_K))
+            low, high = 1 - adj_drift, 1 + adj_drift
+            for g in range(num_genotypes):
+                males[g] = 0.0 if cell_K == 0 else np.rint(males[g] * (low + (high - low) * drift_noise[r, g, 0, y, x]))
+                females[g] = 0.0 if cell_K == 0 else np.rint(females[g] * (low + (high - low) * drift_noise[r, g, 1, y, x]))
+
+            # Bottleneck
+            if bottleneck and next_N > bottleneck_N:
+                adj_drift = (1 - bottleneck_N / next_N) * (1 - (bottleneck_N / safe_K))
+                low, high = 1 - adj_drift, 1 + adj_drift
+                for g in range(num_genotypes):
+                    males[g] = 0.0 if cell_K == 0 else np.rint(males[g] * (low + (high - low) * bottleneck_noise[r, g, 0, y, x]))
+                    females[g] = 0.0 if cell_K == 0 else np.rint(females[g] * (low + (high - low) * bottleneck_noise[r, g, 1, y, x]))
+                next_N = bottleneck_N
+
+            # Mating, through the transmission tensor
+            N = 0.0
+            for g in range(num_genotypes):
+                N += males[g] + females[g]
+            if N != 0:
+                for a in range(num_genotypes):
+                    for b in range(num_genotypes):
+                        matings = (males[a] * females[b] + males[b] * females[a]) / N
+                        covariance_effect = (covariances[a, y, x] + covariances[b, y, x]) / 2
+                        matings *= 1 + covariance_effect if a == b else 1 - covariance_effect
+                        if matings != 0:
+                            for c in range(num_genotypes):
+                                offspring[c] += matings * T[a, b, c]
+
+                total = 0.0
+                for g in range(num_genotypes):
+                    total += offspring[g]
+                for g in range(num_genotypes):
+                    count = 0.0 if total == 0 else np.rint((offspring[g] / 2) / total * (next_N * growth_rate))
+                    males[g] = count
+                    females[g] = count
+
+            # Mutation, clamped to the counts of the source genotype
+            for g in range(num_genotypes):
+                out[r, g, 0, y, x] = males[g]
+                out[r, g, 1, y, x] = females[g]
+            if mutate:
+                for a in range(num_genotypes):
+                    total = males[a] + females[a]
+                    if total <= 0:
+                        continue
+                    for b in range(num_genotypes):
+                        if a == b:
+                            continue
+                        N_mutations = np.trunc((total * mutation_probabilities[a, b]) / (num_genotypes * 2))
+                        N_mutations = min(N_mutations, males[a], females[a])
+                        out[r, a, 0, y, x] -= N_mutations
+                        out[r, a, 1, y, x] -= N_mutations
+                        out[r, b, 0, y, x] += N_mutations
+                        out[r, b, 1, y, x] += N_mutations
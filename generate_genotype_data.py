@@ -1,6 +1,8 @@
 import itertools
-from collections import defaultdict
-import random
+
+import numpy as np
+
+from genotype_registry import generate_genotype_registry
 
 def generate_genotype_data(loci,
                            alleles,
@@ -41,7 +43,7 @@ def generate_genotype_data(loci,
     }
     """
 
-    if seed: random.seed(seed)
+    rng = np.random.default_rng(seed)
 
     loci_letters = [chr(ord('A') + i) for i in range(loci)]
     alleles_numbers = [f"{loci_letters[i]}{j+1}" for i in range(loci) for j in range(alleles)]
@@ -53,22 +55,22 @@ def generate_genotype_data(loci,
 
     genotypes = list(itertools.product(*all_locus_combinations))
 
-    genotype_data = defaultdict(lambda: {
-        'Nm': int(random.gauss(Nm_avg, Nm_std)) if not Nm else Nm // len(genotypes), 
-        'Nf': int(random.gauss(Nf_avg, Nf_std)) if not Nf else Nf // len(genotypes), 
-        'fitness': round(random.uniform(0, 1), 1),
-        'covariance': random.gauss(covariance_avg, covariance_std) if covariance_avg and covariance_std else 0
-    })
-
-    for genotype in genotypes:
-        sorted_genotype = tuple(tuple(sorted(pair)) for pair in genotype)
-        genotype_data[sorted_genotype]
+    # The registry holds the genotypes sorted and without duplicates
+    genotype_data = {
+        genotype: {
+            'Nm': int(rng.normal(Nm_avg, Nm_std)) if not Nm else Nm // len(genotypes), 
+            'Nf': int(rng.normal(Nf_avg, Nf_std)) if not Nf else Nf // len(genotypes), 
+            'fitness': round(rng.uniform(0, 1), 1),
+            'covariance': rng.normal(covariance_avg, covariance_std) if covariance_avg and covariance_std else 0
+        }
+        for genotype in generate_genotype_registry(genotypes)
+    }
 
     # Set fitness to 1 for a random genotype to emulate relative fitness
-    random_genotype = random.choice(list(genotype_data.keys()))
+    random_genotype = list(genotype_data.keys())[rng.integers(len(genotype_data))]
     genotype_data[random_genotype]['fitness'] = 1.0
 
-    return dict(genotype_data)
+    return genotype_data
 
 # # Example usage
 # loci = 2
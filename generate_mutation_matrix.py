@@ -0,0 +1,29 @@
+from functools import lru_cache
+
+import numpy as np
+
+from genotype_registry import generate_genotype_registry
+
+@lru_cache(maxsize=None)
+def _mutation_matrix(genotypes, mutation_rate):
+    distances = generate_genotype_registry(genotypes).distances
+    M = np.where(distances == 0, 0, np.power(float(mutation_rate), distances))
+
+    M.setflags(write=False)
+    return M
+
+def generate_mutation_matrix(genotypes, mutation_rate):
+    """
+    Generates the mutation matrix M[a, b] = mutation_rate ** distance(a, b), the probability that genotype a
+    mutates into genotype b, with 0 on the diagonal, indexed in the order of genotypes.
+
+    The matrix is built once per set of genotypes and mutation rate and cached, so it is read-only.
+
+    Args:
+    - genotypes: Iterable of sorted genotype tuples.
+    - mutation_rate: The probability of a single allele mutating.
+
+    Returns:
+    - A (G, G) numpy array.
+    """
+    return _mutation_matrix(tuple(genotypes), mutation_rate)
@@ -0,0 +1,64 @@
+from functools import lru_cache
+
+import numpy as np
+
+from generate_punnett_square import generate_punnett_square
+from genotype_registry import generate_genotype_registry
+
+@lru_cache(maxsize=None)
+def _transmission_tensor(genotypes):
+    registry = generate_genotype_registry(genotypes)
+
+    T = np.zeros((len(genotypes), len(genotypes), len(genotypes)))
+    for a, genotype_A in enumerate(genotypes):
+        for b, genotype_B in enumerate(genotypes):
+            for genotype, frequency in generate_punnett_square(genotype_A, genotype_B).items():
+                T[a, b, registry.id(genotype)] = frequency
+
+    T.setflags(write=False)
+    return T
+
+def generate_transmission_tensor(genotypes):
+    """
+    Generates the transmission tensor T[a, b, c], the probability that parents with genotypes a and b
+    produce offspring with genotype c, indexed in the order of genotypes.
+
+    The tensor is built from generate_punnett_square once per set of genotypes (i.e. per loci and alleles
+    configuration) and cached, so it is read-only.
+
+    Args:
+    - genotypes: Iterable of sorted genotype tuples.
+
+    Returns:
+    - A (G, G, G) numpy array.
+    """
+    return _transmission_tensor(tuple(genotypes))
+
+@lru_cache(maxsize=None)
+def _locus_transmission_tensors(genotypes):
+    locus_indices = []
+    tensors = []
+    for locus in range(len(genotypes[0])):
+        locus_genotypes = sorted(set((genotype[locus],) for genotype in genotypes))
+        genotype_indices = {locus_genotype: i for i, locus_genotype in enumerate(locus_genotypes)}
+
+        locus_indices.append([genotype_indices[(genotype[locus],)] for genotype in genotypes])
+        tensors.append(_transmission_tensor(tuple(locus_genotypes)))
+
+    locus_indices = np.array(locus_indices)
+    locus_indices.setflags(write=False)
+    return locus_indices, tuple(tensors)
+
+def generate_locus_transmission_tensors(genotypes):
+    """
+    Generates one transmission tensor per locus for loci that segregate independently, so the full tensor is
+    their Kronecker product: T[a, b, c] = prod_l T_l[a_l, b_l, c_l]. Memory grows linearly in the number of loci.
+
+    Args:
+    - genotypes: Iterable of sorted genotype tuples.
+
+    Returns:
+    - locus_indices: (loci, G) array, the index of each genotype's single-locus genotype at every locus.
+    - tensors: Tuple of (G_l, G_l, G_l) single-locus transmission tensors.
+    """
+    return _locus_transmission_tensors(tuple(genotypes))
@@ -0,0 +1,119 @@
+from functools import lru_cache, cached_property
+
+import numpy as np
+
+class GenotypeRegistry:
+    """
+    Interns a list of genotypes (e.g. from TopographicalSpeciation.generate_genotypes) as dense integer ids,
+    the order of the genotype axis of the vectorized engine.
+
+    Genotypes are stored in their sorted form ((('A1', 'A2'),) rather than (('A2', 'A1'),)) and sorted only once,
+    here. Lookups accept either form, and the per-genotype allele counts and the pairwise distances are
+    precomputed as arrays so hot paths can work on ids instead of hashing nested tuples.
+
+    """
+    def __init__(self, genotypes):
+        self.genotypes = tuple(dict.fromkeys(self.normalize(genotype) for genotype in genotypes))
+        self.ids = {genotype: i for i, genotype in enumerate(self.genotypes)}
+
+        self.alleles = sorted({allele for genotype in self.genotypes for locus in genotype for allele in locus})
+        self.allele_ids = {allele: i for i, allele in enumerate(self.alleles)}
+
+    @staticmethod
+    def normalize(genotype):
+        return tuple(tuple(sorted(locus)) for locus in genotype)
+
+    def __len__(self):
+        return len(self.genotypes)
+
+    def __iter__(self):
+        return iter(self.genotypes)
+
+    def __getitem__(self, genotype_id):
+        return self.genotypes[genotype_id]
+
+    def __contains__(self, genotype):
+        return self.normalize(genotype) in self.ids
+
+    def id(self, genotype):
+        """
+        The integer id of a genotype, in either sorted or unsorted form.
+        """
+        genotype_id = self.ids.get(genotype)
+        return genotype_id if genotype_id is not None else self.ids[self.normalize(genotype)]
+
+    @cached_property
+    def allele_counts(self):
+        """
+        (G, A) array of the copies of each allele (in the order of alleles) carried by each genotype.
+        """
+        allele_counts = np.zeros((len(self.genotypes), len(self.alleles)))
+        for g, genotype in enumerate(self.genotypes):
+            for locus in genotype:
+                for allele in locus:
+                    allele_counts[g, self.allele_ids[allele]] += 1
+
+        allele_counts.setflags(write=False)
+        return allele_counts
+
+    @cached_property
+    def allele_loci(self):
+        """
+        (A,) array of the locus of each allele.
+        """
+        allele_loci = np.zeros(len(self.alleles), dtype=int)
+        for genotype in self.genotypes:
+            for locus, alleles in enumerate(genotype):
+                for allele in alleles:
+                    allele_loci[self.allele_ids[allele]] = locus
+
+        allele_loci.setflags(write=False)
+        return allele_loci
+
+    @cached_property
+    def heterozygous_loci(self):
+        """
+        (G,) array of the number of heterozygous loci of each genotype.
+        """
+        heterozygous_loci = np.array([sum(len(set(locus)) > 1 for locus in genotype) for genotype in self.genotypes])
+
+        heterozygous_loci.setflags(write=False)
+        return heterozygous_loci
+
+    @cached_property
+    def distances(self):
+        """
+        (G, G) array of the number of allele positions at which each pair of genotypes differs.
+        """
+        alleles = np.array([[self.allele_ids[allele] for locus in genotype for allele in locus] for genotype in self.genotypes])
+        distances = (alleles[:, None, :] != alleles[None, :, :]).sum(axis=-1)
+
+        distances.setflags(write=False)
+        return distances
+
+    def to_array(self, genotype_data):
+        """
+        Converts a genotype data dict into a (G, 2) array of Nm and Nf, in id order.
+        """
+        counts = np.zeros((len(self.genotypes), 2))
+        for genotype, data in genotype_data.items():
+            counts[self.id(genotype)] = (data['Nm'], data['Nf'])
+        return counts
+
+    def from_array(self, counts):
+        """
+        Converts a (G, 2) array of Nm and Nf back into a genotype data dict.
+        """
+        return {genotype: {'Nm': Nm, 'Nf': Nf} for genotype, (Nm, Nf) in zip(self.genotypes, counts.tolist())}
+
+@lru_cache(maxsize=None)
+def _genotype_registry(genotypes):
+    return GenotypeRegistry(genotypes)
+
+def generate_genotype_registry(genotypes):
+    """
+    Returns the GenotypeRegistry of a list of genotypes, built once per list and cached.
+    """
+    if isinstance(genotypes, GenotypeRegistry):
+        return genotypes
+    return _genotype_registry(tuple(genotypes))
@@ -0,0 +1,284 @@
+import numpy as np
+from scipy.signal import fftconvolve
+
+from generate_transmission_tensor import generate_transmission_tensor
+from generate_mutation_matrix import generate_mutation_matrix
+from calc_next_genotypes_data import calc_factorized_offspring
+from rng import RandomStreams
+from stage_timer import NULL_TIMER
+
+# The grid engine stores the whole map as a dense array shaped (..., genotype, sex, height, width),
+# where sex 0 is Nm and sex 1 is Nf. Any leading axes are carried along untouched.
+
+NM = 0
+NF = 1
+
+# 'uniform' scales counts by random factors up to max_drift, 'wright_fisher' resamples each cell's offspring
+DRIFT_MODES = ('uniform', 'wright_fisher')
+
+
+def cells_to_grid(cells, genotypes):
+    """
+    Converts the latest generation of a 2d list of cells into a (genotype, sex, height, width) count array
+    and a (genotype, height, width) covariance array.
+
+    """
+    height, width = len(cells), len(cells[0])
+    grid = np.zeros((len(genotypes), 2, height, width))
+    covariances = np.zeros((len(genotypes), height, width))
+
+    for y in range(height):
+        for x in range(width):
+            genotype_data = cells[y][x].gens_genotype_data[-1]
+            for g, genotype in enumerate(genotypes):
+                grid[g, NM, y, x] = genotype_data[genotype]['Nm']
+                grid[g, NF, y, x] = genotype_data[genotype]['Nf']
+                covariances[g, y, x] = genotype_data[genotype]['covariance']
+
+    return grid, covariances
+
+
+def calc_N_grid(grid):
+    """
+    Counts the population size of every cell.
+
+    """
+    return grid.sum(axis=(-4, -3))
+
+
+def calc_active_cells(grid):
+    """
+    Mask of the cells with any individuals (in any replicate), shaped (height, width).
+
+    """
+    return (calc_N_grid(grid) > 0).reshape((-1,) + grid.shape[-2:]).any(axis=0)
+
+
+def calc_active_window(active):
+    """
+    The bounding box (y0, y1, x0, x1) of the active cells of a (height, width) mask, or None if there are none.
+
+    Empty cells stay empty through every per-cell step of a generation, so only this window needs computing.
+
+    """
+    rows, cols = np.flatnonzero(active.any(axis=1)), np.flatnonzero(active.any(axis=0))
+    if len(rows) == 0:
+        return None
+    return int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1
+
+
+def calc_next_N_grid(N, r, K):
+    """
+    Vectorized calc_next_N: Verhulst's logistic growth for every cell, with dN = N * r where K is 0.
+
+    """
+    safe_K = np.where(K == 0, 1, K)
+    dN = np.where(K == 0, N * r, r * N * (1 - (N / safe_K)))
+    return np.maximum(1, N + dN)
+
+
+def adj_grid_by_fitness(grid, fitnesses):
+    """
+    Adjust genotype counts of every cell by their fitness, where fitnesses is shaped (genotype, height, width).
+
+    """
+    return np.round(grid * fitnesses[:, None])
+
+
+def adj_grid_by_drift(grid, max_drift, N, K, rng=np.random):
+    """
+    Vectorized adj_by_drift. max_drift may be a scalar or a per-cell array.
+    Cells with a carrying capacity of 0 are emptied. rng is anything with a uniform(low, high) method.
+
+    """
+    safe_K = np.where(K == 0, 1, K)
+    adj_drift = max_drift * (1 - (N / safe_K))
+    adj_drift = np.broadcast_to(adj_drift[..., None, None, :, :], grid.shape)
+
+    drifted = np.round(grid * rng.uniform(1 - adj_drift, 1 + adj_drift))
+    return np.where(K == 0, 0, drifted)
+
+
+def calc_next_grid(grid, K, fitnesses, covariances, genotypes, growth_rate, max_drift, mutation_rate,
+                   bottleneck_N=None, factorized=False, rng=np.random, drift_mode='uniform', timer=NULL_TIMER):
+    """
+    Applies every per-cell step of a generation after gene flow: logistic growth, fitness, drift,
+    the bottleneck (if bottleneck_N is given), mating and mutation. Each step is timed by timer (see StageTimer).
+
+    With the 'wright_fisher' drift_mode, max_drift is ignored and the offspring are resampled after mutation instead.
+
+    """
+    if drift_mode not in DRIFT_MODES:
+        raise ValueError(f"drift_mode must be one of {DRIFT_MODES}.")
+    uniform_drift = drift_mode == 'uniform'
+
+    with timer.stage('growth'):
+        next_N = calc_next_N_grid(calc_N_grid(grid), growth_rate, K)
+
+    # Apply evolutionary forces to genotypes in the current generation
+    with timer.stage('fitness'):
+        grid = adj_grid_by_fitness(grid, fitnesses)
+    if uniform_drift:
+        with timer.stage('drift'):
+            grid = adj_grid_by_drift(grid, max_drift, calc_N_grid(grid), K, rng)
+
+    # If bottleneck, adjust population size, apply drift
+    if bottleneck_N is not None:
+        with timer.stage('bottleneck'):
+            bottlenecked = next_N > bottleneck_N
+            if uniform_drift:
+                bottleneck_drift = np.where(bottlenecked, 1 - bottleneck_N / next_N, 0)
+                grid = np.where(bottlenecked, adj_grid_by_drift(grid, bottleneck_drift, bottleneck_N, K, rng), grid)
+            next_N = np.where(bottlenecked, bottleneck_N, next_N)
+
+    # Calculate the next generation
+    with timer.stage('mating'):
+        grid = calc_next_genotypes_grid(grid, covariances, genotypes, next_N * growth_rate, factorized)
+    with timer.stage('mutation'):
+        grid = adj_grid_by_mutation(grid, genotypes, mutation_rate)
+
+    if not uniform_drift:
+        with timer.stage('drift'):
+            grid = adj_grid_by_wright_fisher(grid, K, rng)
+    return grid
+
+
+def adj_grid_by_wright_fisher(grid, K, rng=np.random):
+    """
+    Vectorized adj_by_wright_fisher. Redraws the individuals of every cell at once by a batched multinomial
+    over genotypes and a binomial split into sexes. Cells with a carrying capacity of 0 are emptied.
+    rng is a numpy Generator or anything with the same multinomial(n, pvals) and binomial(n, p) methods.
+
+    """
+    if rng is np.random:
+        # The legacy global generator can't draw batched multinomials
+        rng = RandomStreams().generator('drift')
+
+    counts = grid.sum(axis=-3)
+    N = counts.sum(axis=-3)
+    safe_N = np.where(N == 0, 1, N)
+
+    pvals = np.moveaxis(counts / safe_N[..., None, :, :], -3, -1)
+    counts = np.moveaxis(rng.multinomial(np.round(N).astype(np.int64), pvals), -1, -3)
+    males = rng.binomial(counts, 0.5)
+
+    # Masked after the draw so every cell's noise stays where it was
+    return np.where(K == 0, 0, np.stack([males, counts - males], axis=-3).astype(float))
+
+
+def calc_next_genotypes_grid(grid, covariances, genotypes, next_N, factorized=False):
+    """
+    Vectorized calc_next_genotypes_data. Mates every pair of genotypes in every cell at once through the
+    cached transmission tensor, or locus by locus if factorized, and rescales the offspring frequencies to next_N.
+
+    """
+    N = calc_N_grid(grid)
+    safe_N = np.where(N == 0, 1, N)
+    males, females = grid[..., NM, :, :], grid[..., NF, :, :]
+
+    if factorized:
+        if covariances.any():
+            raise ValueError("Factorized mating requires zero covariance.")
+        next_grid = _rescale_offspring(calc_factorized_offspring(males, females, genotypes), next_N)
+        return np.where(N[..., None, None, :, :] == 0, grid, next_grid)
+
+    matings = np.einsum('...ahw,...bhw->...abhw', males, females)
+    matings = (matings + np.swapaxes(matings, -4, -3)) / safe_N[..., None, None, :, :]
+
+    if covariances.any():
+        covariance_effect = (covariances[:, None] + covariances[None, :]) / 2
+        is_same = np.eye(len(genotypes), dtype=bool)[:, :, None, None]
+        matings *= np.where(is_same, 1 + covariance_effect, 1 - covariance_effect)
+
+    offspring = np.einsum('...abhw,abc->...chw', matings, generate_transmission_tensor(genotypes), optimize=True)
+
+    next_grid = _rescale_offspring(offspring, next_N)
+    return np.where(N[..., None, None, :, :] == 0, grid, next_grid)
+
+
+def _rescale_offspring(offspring, next_N):
+    """
+    Splits offspring evenly between sexes, normalizes them to frequencies and turns them back into counts.
+
+    """
+    total = offspring.sum(axis=-3)
+    safe_total = np.where(total == 0, 1, total)
+
+    frequencies = (offspring / 2) / safe_total[..., None, :, :]
+    counts = np.round(frequencies * next_N[..., None, :, :])
+    counts = np.where(total[..., None, :, :] == 0, 0, counts)
+
+    return np.stack([counts, counts], axis=-3)
+
+
+def adj_grid_by_mutation(grid, genotypes, mutation_rate):
+    """
+    Vectorized adj_by_mutation. Each ordered pair of genotypes exchanges int(N * mutation_rate ** distance / (2G))
+    individuals of each sex, clamped to the original counts of the source genotype.
+    Mutations out of each source genotype are computed for every target genotype and cell at once from the cached
+    mutation matrix, so there are G rather than G^2 array operations.
+
+    """
+    if mutation_rate is None:
+        return grid
+
+    M = generate_mutation_matrix(genotypes, mutation_rate)
+    num_genotypes = len(genotypes)
+    males, females = grid[..., NM, :, :], grid[..., NF, :, :]
+    total = males + females
+    max_mutations = np.where(total > 0, np.minimum(males, females), 0)
+
+    N_mutated = np.zeros(total.shape)
+    for a in range(num_genotypes):
+        # Mutations from genotype a into every genotype b, shaped (..., b, height, width)
+        N_mutations = np.trunc((total[..., a, None, :, :] * M[a, :, None, None]) / (num_genotypes * 2))
+        N_mutations = np.minimum(N_mutations, max_mutations[..., a, None, :, :])
+
+        N_mutated += N_mutations
+        N_mutated[..., a, :, :] -= N_mutations.sum(axis=-3)
+
+    return grid + N_mutated[..., None, :, :]
+
+
+def calc_gene_flow_grid(grid, K, distances):
+    """
+    Vectorized append_gene_flow_cells. Cells over their carrying capacity send a share (N - K) / N of each
+    genotype to every cell within their integer gene flow distance, weighted by 1 / Manhattan distance.
+    distances is shaped (genotype, height, width).
+
+    Sources are grouped by their integer distance and each group is spread with one FFT convolution
+    of its kernel over the whole map.
+
+    """
+    N = calc_N_grid(grid)
+    safe_N = np.where(N == 0, 1, N)
+    rate = np.where((N > K) & (N > 0), (N - K) / safe_N, 0)[..., None, None, :, :]
+
+    max_distances = distances.astype(int)[:, None]
+    flowing = (rate > 0) & (grid > 0) & (max_distances > 0)
+
+    new_grid = np.where(flowing, grid * (1 - rate), grid)
+    outflow = np.where(flowing, rate * grid, 0)
+
+    for max_distance in np.unique(max_distances[max_distances > 0]):
+        sources = np.where(max_distances == max_distance, outflow, 0)
+        if not sources.any():
+            continue
+
+        kernel = calc_gene_flow_kernel(max_distance)
+        inflow = fftconvolve(sources, kernel.reshape((1,) * (grid.ndim - 2) + kernel.shape), mode='same', axes=(-2, -1))
+
+        # Every term is non-negative, so anything below 0 is FFT round-off
+        new_grid += np.maximum(inflow, 0)
+
+    return new_grid
+
+
+def calc_gene_flow_kernel(max_distance):
+    """
+    The (2d+1, 2d+1) gene flow kernel: 1 / Manhattan distance from the center, and 0 at the center.
+
+    """
+    offsets = np.abs(np.arange(-max_distance, max_distance + 1))
+    distance = offsets[:, None] + offsets[None, :]
+    return np.where(distance > 0, 1 / np.where(distance > 0, distance, 1), 0)
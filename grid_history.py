@@ -0,0 +1,210 @@
+import os
+from collections.abc import Sequence
+
+import numpy as np
+
+from grid_engine import NM, NF
+
+class GridHistory:
+    """
+    Stores the grid of every generation in one preallocated array shaped (generation, genotype, sex, height, width).
+
+    Counts are stored with a compact dtype (float32 by default, or an integer type, in which case they are
+    rounded), while the engine keeps the current generation in full precision.
+    cell_view(y, x) gives a read-only, list-of-dicts compatible view of one cell's history for
+    the Animator and the calc_* functions.
+
+    If path is given, the array is a memory-mapped .npy file, with the genotypes, covariances and carrying
+    capacity in a .meta.npz file next to it, so runs can exceed RAM and be reopened lazily with GridHistory.open.
+    Only every stride-th generation is recorded.
+
+    """
+    def __init__(self, grid, genotypes, covariances, carrying_capacity=None, capacity=1, dtype=np.float32,
+                 path=None, stride=1):
+        self.genotypes = genotypes
+        self.covariances = covariances
+        self.carrying_capacity = carrying_capacity
+        self.dtype = np.dtype(dtype)
+        self.path = path
+        self.stride = stride
+
+        self.data = self._allocate((max(1, capacity),) + grid.shape)
+        self.length = 0
+        self.generations_seen = 0
+        self.append(grid)
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        """
+        Opens a history written to path, read-only by default. Frames are only read from disk when accessed.
+        """
+        history = cls.__new__(cls)
+        with np.load(meta_path(path)) as meta:
+            history.genotypes = genotypes_from_array(meta['genotypes'])
+            history.covariances = meta['covariances']
+            history.carrying_capacity = meta['carrying_capacity'] if meta['carrying_capacity'].ndim else None
+            history.length = int(meta['length'])
+            history.stride = int(meta['stride'])
+
+        history.path = path
+        history.data = np.load(path, mmap_mode=mode)
+        history.dtype = history.data.dtype
+        history.generations_seen = history.length * history.stride
+        return history
+
+    @classmethod
+    def from_frames(cls, frames, genotypes, covariances, carrying_capacity=None, capacity=1, stride=1, generations_seen=None):
+        """
+        Rebuilds an in-memory history from previously recorded frames.
+        """
+        history = cls(frames[0], genotypes, covariances, carrying_capacity, max(capacity, len(frames)), frames.dtype, stride=stride)
+        history.data[:len(frames)] = frames
+        history.rewind(generations_seen if generations_seen is not None else len(frames) * stride)
+        return history
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        """
+        Returns the grid of a recorded generation, or a stack of grids for a slice.
+        """
+        return self.data[:self.length][idx]
+
+    @property
+    def recorded_generations(self):
+        return np.arange(self.length) * self.stride
+
+    def _allocate(self, shape, path=None):
+        path = path or self.path
+        if path is None:
+            return np.zeros(shape, dtype=self.dtype)
+        return np.lib.format.open_memmap(path, mode='w+', dtype=self.dtype, shape=shape)
+
+    def reserve(self, capacity):
+        """
+        Grows the preallocated array to hold at least capacity recorded generations.
+        """
+        if capacity <= len(self.data):
+            return
+
+        shape = (capacity,) + self.data.shape[1:]
+        if self.path is None:
+            data = self._allocate(shape)
+            data[:self.length] = self.data[:self.length]
+            self.data = data
+            return
+
+        # Memory-mapped files can't grow in place, so copy into a larger file and swap it in
+        tmp_path = self.path + '.tmp'
+        data = self._allocate(shape, tmp_path)
+        data[:self.length] = self.data[:self.length]
+        data.flush()
+        del data
+        del self.data
+        os.replace(tmp_path, self.path)
+        self.data = np.load(self.path, mmap_mode='r+')
+
+    def append(self, grid):
+        record = self.generations_seen % self.stride == 0
+        self.generations_seen += 1
+        if not record:
+            return
+
+        if self.length == len(self.data):
+            self.reserve(2 * len(self.data))
+
+        if np.issubdtype(self.dtype, np.integer):
+            grid = np.rint(grid)
+        self.data[self.length] = grid
+        self.length += 1
+
+    def rewind(self, generations_seen):
+        """
+        Forgets everything appended after the first generations_seen generations.
+        """
+        self.generations_seen = generations_seen
+        self.length = -(-generations_seen // self.stride)
+
+    def flush(self):
+        """
+        Writes memory-mapped frames and the metadata to disk.
+        """
+        if self.path is None:
+            return
+
+        self.data.flush()
+        np.savez(meta_path(self.path),
+                 genotypes=np.array(self.genotypes),
+                 covariances=self.covariances,
+                 carrying_capacity=self.carrying_capacity if self.carrying_capacity is not None else np.array(np.nan),
+                 length=self.length,
+                 stride=self.stride)
+
+    def cell_view(self, y, x, replicate=0):
+        return CellHistoryView(self, y, x, replicate)
+
+    def generate_cells(self):
+        """
+        Generates a 2d list of lightweight cells reading from this history, for the Animator.
+        """
+        height, width = self.data.shape[-2:]
+        return [[HistoryCell(self, x, y) for x in range(width)] for y in range(height)]
+
+
+def meta_path(path):
+    return os.path.splitext(path)[0] + '.meta.npz'
+
+
+def genotypes_from_array(genotypes):
+    """
+    Converts a (genotype, locus, 2) array of allele names back into a list of genotype tuples.
+    """
+    return [tuple(tuple(str(allele) for allele in locus) for locus in genotype) for genotype in genotypes]
+
+
+class CellHistoryView(Sequence):
+    """
+    Read-only view of one cell's history in the gens_genotype_data format:
+    view[i][genotype] == {'Nm': ..., 'Nf': ..., 'covariance': ...}
+
+    If the history has a replicate axis, the view reads the given replicate.
+
+    """
+    def __init__(self, history, y, x, replicate=0):
+        self.history = history
+        self.y = y
+        self.x = x
+        self.replicate = replicate
+
+    def __len__(self):
+        return len(self.history)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+
+        grid = self.history[idx]
+        if grid.ndim == 5:
+            grid = grid[self.replicate]
+        return {
+            genotype: {
+                'Nm': grid[g, NM, self.y, self.x].item(),
+                'Nf': grid[g, NF, self.y, self.x].item(),
+                'covariance': self.history.covariances[g, self.y, self.x].item(),
+            }
+            for g, genotype in enumerate(self.history.genotypes)
+        }
+
+
+class HistoryCell:
+    """
+    A cell whose gens_genotype_data is read from a GridHistory.
+
+    """
+    def __init__(self, history, x, y):
+        self.x = x
+        self.y = y
+        self.genotypes = history.genotypes
+        self.carrying_capacity = history.carrying_capacity[y][x] if history.carrying_capacity is not None else 0
+        self.gens_genotype_data = history.cell_view(y, x)
@@ -1,12 +1,14 @@
 from generate_genotype_data import generate_genotype_data
+from rng import RandomStreams
+from grid_engine import DRIFT_MODES
 
 from calc_N import calc_N
 from calc_next_N import calc_next_N
-from calc_N_sub import calc_N_sub
 
 from adj_by_fitness import adj_by_fitness
 from adj_by_drift import adj_by_drift
 from adj_by_mutation import adj_by_mutation
+from adj_by_wright_fisher import adj_by_wright_fisher
 
 from calc_next_genotypes_data import calc_next_genotypes_data
 
@@ -17,48 +19,118 @@ from calc_allele_frequencies import calc_allele_frequencies
 from calc_population_sizes import calc_population_sizes
 from calc_avgerage_fitness import calc_avgerage_fitness
 
-from calc_Ne import calc_Ne_over_generations
+from statistics_collector import StatisticsCollector
+from convergence_detector import ConvergenceDetector
+from stage_timer import NULL_TIMER
 
 from plot import create_plot
 
 class PopGen:
-    def __init__(self, growth_rate=0, carrying_capacity=None, max_drift=0, mutation_rate=None):
+    def __init__(self, growth_rate=0, carrying_capacity=None, max_drift=0, mutation_rate=None, drift_mode='uniform'):
         self.growth_rate = growth_rate
         self.carrying_capacity = carrying_capacity
         self.max_drift = max_drift
         self.mutation_rate = mutation_rate
+        # 'uniform' drift up to max_drift, or 'wright_fisher' to resample the offspring (ignores max_drift)
+        self.drift_mode = drift_mode
+        # Running statistics of the recorded generations, see StatisticsCollector
+        self.statistics = None
+        # Seed of the drift; None draws one from np.random
+        self.seed = None
+        # Streams of the drift, so calc_generation can be called on its own; run() re-seeds them from seed
+        self.streams = RandomStreams(self.seed)
+        # Stop early on extinction, fixation or equilibrium, see ConvergenceDetector
+        self.stop_early = False
+        self.convergence_tolerance = 1e-4
+        self.convergence_patience = 10
+        self.stop_on_fixation = True
+        self.convergence = None
+        self.stop_generation = None
+        self.stop_reason = None
+        # Optional StageTimer timing each stage of every generation, and a callback called with (generation, simulation)
+        # after each generation
+        self.timer = None
+        self.progress = None
         self._gens_genotype_data = []
     
     def run(self, generations, bottleneck_yr=None, bottleneck_N=None):
         if self.genotype_data is None:
             raise ValueError("Genotype data must be provided")
+
+        self.streams = RandomStreams(self.seed)
+        
+        self.stop_generation = self.stop_reason = None
+        self.convergence = None
+        if self.stop_early:
+            self.convergence = ConvergenceDetector(self.genotype_data.keys(), self.convergence_tolerance, self.convergence_patience, self.stop_on_fixation)
+            self.convergence.update(self.calc_counts())
         
         # Repeates for each generation
+        timer = self.timer or NULL_TIMER
         for i in range(generations):
+            timer.start_generation(i)
             self.calc_generation(i, bottleneck_yr, bottleneck_N)
 
+            if self.progress is not None:
+                self.progress(i, self)
+
+            if self.convergence is not None:
+                with timer.stage('convergence'):
+                    converged = self.convergence.update(self.calc_counts())
+                if converged:
+                    self.stop_generation, self.stop_reason = i, self.convergence.reason
+                    break
+
         return self._gens_genotype_data
 
     def calc_generation(self, i, bottleneck_yr=None, bottleneck_N=None):
-        # Append the next generation to the list of generations
-        self._gens_genotype_data.append(self.genotype_data)
+        if self.drift_mode not in DRIFT_MODES:
+            raise ValueError(f"drift_mode must be one of {DRIFT_MODES}.")
+        timer = self.timer or NULL_TIMER
 
-        curr_genotypes_data = self._gens_genotype_data[-1]
-        next_N = calc_next_N(calc_N(curr_genotypes_data), self.growth_rate, self.carrying_capacity)
+        # Append the next generation to the list of generations
+        with timer.stage('history'):
+            self._gens_genotype_data.append(self.genotype_data)
+        with timer.stage('statistics'):
+            if self.statistics is None:
+                self.statistics = StatisticsCollector(self.genotype_data.keys())
+            self.statistics.update_genotype_data(self.genotype_data)
+
+        # Copy so that the recorded generation isn't adjusted in place
+        curr_genotypes_data = {genotype: data.copy() for genotype, data in self._gens_genotype_data[-1].items()}
+        rng = self.streams.generator('drift', i)
+        with timer.stage('growth'):
+            next_N = calc_next_N(calc_N(curr_genotypes_data), self.growth_rate, self.carrying_capacity)
 
         # Apply evolutionary forces to genotypes in the current generation
-        curr_genotypes_data = adj_by_fitness(curr_genotypes_data)
-        curr_genotypes_data = adj_by_drift(curr_genotypes_data, self.max_drift, calc_N(curr_genotypes_data), self.carrying_capacity)
+        with timer.stage('fitness'):
+            curr_genotypes_data = adj_by_fitness(curr_genotypes_data)
+        if self.drift_mode == 'uniform':
+            with timer.stage('drift'):
+                curr_genotypes_data = adj_by_drift(curr_genotypes_data, self.max_drift, calc_N(curr_genotypes_data), self.carrying_capacity, rng)
 
         # If bottleneck, adjust population size, apply drift
         if bottleneck_yr == i and next_N > bottleneck_N:
-            curr_genotypes_data = adj_by_drift(curr_genotypes_data, 1-bottleneck_N/next_N, bottleneck_N, self.carrying_capacity)
-            next_N = bottleneck_N
+            with timer.stage('bottleneck'):
+                if self.drift_mode == 'uniform':
+                    curr_genotypes_data = adj_by_drift(curr_genotypes_data, 1-bottleneck_N/next_N, bottleneck_N, self.carrying_capacity, rng)
+                next_N = bottleneck_N
 
         # Calculate the next generation
-        self.genotype_data = calc_next_genotypes_data(curr_genotypes_data, next_N)
-        self.genotype_data = adj_by_mutation(self.genotype_data, self.mutation_rate)
+        with timer.stage('mating'):
+            self.genotype_data = calc_next_genotypes_data(curr_genotypes_data, next_N)
+        with timer.stage('mutation'):
+            self.genotype_data = adj_by_mutation(self.genotype_data, self.mutation_rate)
+        if self.drift_mode == 'wright_fisher':
+            with timer.stage('drift'):
+                self.genotype_data = adj_by_wright_fisher(self.genotype_data, self.carrying_capacity, rng)
     
+    def calc_counts(self):
+        """
+        The counts of the next generation as a one-cell map, shaped (genotype, sex, 1, 1), for the ConvergenceDetector.
+        """
+        return self.convergence.registry.to_array(self.genotype_data)[..., None, None]
+
     def generate_genotype_data(self, *args):
         return generate_genotype_data(*args)
     
@@ -83,13 +155,7 @@ class PopGen:
         fig.show()
     
     def plot_effective_population_sizes(self):
-        gens_Nm = calc_N_sub(self._gens_genotype_data, 'Nm')
-        gens_Nf = calc_N_sub(self._gens_genotype_data, 'Nf')
-        gens_allele_freqs = calc_allele_frequencies(self._gens_genotype_data)
-
-        gens_Ne = calc_Ne_over_generations(gens_Nm, gens_Nf, gens_allele_freqs)
-
-        fig = create_plot('Effective Population Size', gens_Ne, 'Effective Population Size')
+        fig = create_plot('Effective Population Size', self.statistics.gens_Ne, 'Effective Population Size')
         fig.show()
     
     def plot_average_fitness(self):
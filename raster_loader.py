@@ -0,0 +1,155 @@
+import os
+
+import numpy as np
+
+# GeoTIFF support is optional and needs rasterio
+try:
+    import rasterio
+    from rasterio.windows import Window
+except ImportError:
+    rasterio = None
+
+
+def open_raster(path):
+    """
+    Opens a raster (.npy, ESRI ASCII grid .asc/.txt, or GeoTIFF .tif/.tiff) for reading rows lazily.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.npy':
+        return NpyRaster(path)
+    if extension in ('.asc', '.txt'):
+        return AsciiRaster(path)
+    if extension in ('.tif', '.tiff'):
+        if rasterio is None:
+            raise ImportError("Reading GeoTIFF rasters requires rasterio.")
+        return GeoTiffRaster(path)
+    raise ValueError("Rasters must be .npy, .asc, .txt, .tif or .tiff files.")
+
+
+class NpyRaster:
+    """
+    A 2d .npy array, memory-mapped.
+    """
+    def __init__(self, path):
+        self.data = np.load(path, mmap_mode='r')
+        if self.data.ndim != 2:
+            raise ValueError("A .npy raster must be a 2d array.")
+        self.shape = self.data.shape
+        self.nodata = None
+
+    def read_rows(self, start, stop):
+        return np.asarray(self.data[start:stop], dtype=float)
+
+
+class AsciiRaster:
+    """
+    An ESRI ASCII grid, read sequentially, so only the requested rows are held in memory.
+    """
+    def __init__(self, path):
+        self.path = path
+        header = {}
+        with open(path) as f:
+            while True:
+                position = f.tell()
+                line = f.readline()
+                key = line.split()[0].lower() if line.split() else ''
+                if key not in ('ncols', 'nrows', 'xllcorner', 'yllcorner', 'xllcenter', 'yllcenter', 'cellsize', 'nodata_value'):
+                    break
+                header[key] = float(line.split()[1])
+        self.data_start = position
+
+        self.shape = (int(header['nrows']), int(header['ncols']))
+        self.nodata = header.get('nodata_value')
+        self.file = None
+        self.row = 0
+
+    def read_rows(self, start, stop):
+        if self.file is None or start < self.row:
+            self.close()
+            self.file = open(self.path)
+            self.file.seek(self.data_start)
+            self.row = 0
+
+        if start > self.row:
+            np.loadtxt(self.file, max_rows=start - self.row, ndmin=2)
+        rows = np.loadtxt(self.file, max_rows=stop - start, ndmin=2)
+        self.row = stop
+
+        return rows.reshape(stop - start, self.shape[1])
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class GeoTiffRaster:
+    """
+    The first band of a GeoTIFF, read through rasterio windows.
+    """
+    def __init__(self, path):
+        self.dataset = rasterio.open(path)
+        self.shape = (self.dataset.height, self.dataset.width)
+        self.nodata = self.dataset.nodata
+
+    def read_rows(self, start, stop):
+        return self.dataset.read(1, window=Window(0, start, self.shape[1], stop - start)).astype(float)
+
+    def close(self):
+        self.dataset.close()
+
+
+def resample_raster(raster, height, width, block_rows=1024):
+    """
+    Resamples a raster to (height, width) cells, each the mean of the raster cells it covers, ignoring no-data
+    (NaN where a cell covers only no-data). Maps finer than the raster repeat the nearest raster cell.
+
+    The raster is read in blocks of about block_rows rows, so it never needs to fit in memory.
+
+    """
+    raster_height, raster_width = raster.shape
+    row_starts = np.arange(height) * raster_height // height
+    row_stops = np.maximum(row_starts + 1, (np.arange(height) + 1) * raster_height // height)
+    col_starts = np.arange(width) * raster_width // width
+    col_counts = np.maximum(1, np.diff(np.append(col_starts, raster_width)))
+
+    resampled = np.empty((height, width))
+    y = 0
+    while y < height:
+        # Cover as many map rows as fit in one block of raster rows
+        y_stop = y + 1
+        while y_stop < height and row_stops[y_stop] - row_starts[y] <= block_rows:
+            y_stop += 1
+
+        block = raster.read_rows(row_starts[y], row_stops[y_stop - 1])
+        valid = ~np.isnan(block)
+        if raster.nodata is not None:
+            valid &= block != raster.nodata
+        block = np.where(valid, block, 0)
+
+        # Sum the columns of every map cell, then the rows
+        col_sums = np.add.reduceat(block, col_starts, axis=1)
+        col_valid = np.add.reduceat(valid.astype(float), col_starts, axis=1)
+        if raster_width < width:
+            col_sums, col_valid = col_sums / col_counts, col_valid / col_counts
+
+        for i in range(y, y_stop):
+            rows = slice(row_starts[i] - row_starts[y], row_stops[i] - row_starts[y])
+            total, count = col_sums[rows].sum(axis=0), col_valid[rows].sum(axis=0)
+            resampled[i] = np.where(count > 0, total / np.where(count > 0, count, 1), np.nan)
+
+        y = y_stop
+
+    return resampled
+
+
+def load_raster(path, height, width, block_rows=1024):
+    """
+    Reads a raster file resampled to (height, width) map cells, see open_raster and resample_raster.
+    """
+    raster = open_raster(path)
+    try:
+        return resample_raster(raster, height, width, block_rows)
+    finally:
+        if hasattr(raster, 'close'):
+            raster.close()
@@ -0,0 +1,90 @@
+import zlib
+
+import numpy as np
+
+class RandomStreams:
+    """
+    Counter-based random streams built on numpy's Philox generator.
+
+    Every stream is keyed by the seed and addressed by (purpose, generation, index, draw), e.g. the drift of
+    one row or cell in one generation. Streams don't share state, so draws don't depend on the order in which
+    cells, tiles or processes ask for them, and one seed reproduces a run at any level of parallelism.
+
+    If seed is None, one is drawn from np.random, so seeding numpy globally still reproduces a run.
+
+    """
+    def __init__(self, seed=None):
+        if seed is None:
+            seed = int(np.random.randint(2**63, dtype=np.int64))
+        self.seed = int(seed)
+
+    def generator(self, purpose, generation=0, index=0, draw=0):
+        """
+        Returns a numpy Generator for one stream. Each stream holds 2^64 blocks of 4 random words.
+        """
+        purpose_id = zlib.crc32(purpose.encode())
+        counter = np.array([0, index, generation, (purpose_id << 32) | draw], dtype=np.uint64)
+        return np.random.Generator(np.random.Philox(key=self.seed % 2**128, counter=counter))
+
+    def row_streams(self, purpose, generation, rows, columns=None, width=None):
+        return RowStreams(self, purpose, generation, rows, columns, width)
+
+
+class RowStreams:
+    """
+    Draws noise for a grid shaped (..., y, x) in bulk from one stream per map row, so the noise of a cell doesn't
+    depend on which tile or process computes it. Each call to uniform uses the next draw of the streams.
+
+    The grid may also be a window of columns (a slice) of rows of the given width. Uniform noise is drawn for the
+    whole rows and cut to the window, while counts are drawn for the window alone, which gives the same counts
+    as long as every cell outside it is empty (numpy draws nothing for n = 0).
+
+    """
+    def __init__(self, streams, purpose, generation, rows, columns=None, width=None):
+        self.streams = streams
+        self.purpose = purpose
+        self.generation = generation
+        self.rows = rows
+        self.columns = columns
+        self.width = width
+        self.draws = 0
+
+    def uniform(self, low, high):
+        low, high = np.broadcast_arrays(low, high)
+        row_shape = low.shape[:-2] + (low.shape[-1] if self.columns is None else self.width,)
+
+        noise = np.stack([
+            self.streams.generator(self.purpose, self.generation, row, self.draws).random(row_shape)
+            for row in self.rows
+        ], axis=-2)
+        if self.columns is not None:
+            noise = noise[..., self.columns]
+        self.draws += 1
+
+        return low + (high - low) * noise
+
+    def multinomial(self, n, pvals):
+        """
+        Draws counts for n shaped (..., y, x) and pvals shaped (..., y, x, category).
+        """
+        counts = np.stack([
+            self.streams.generator(self.purpose, self.generation, row, self.draws).multinomial(n[..., r, :], pvals[..., r, :, :])
+            for r, row in enumerate(self.rows)
+        ], axis=-3)
+        self.draws += 1
+
+        return counts
+
+    def binomial(self, n, p):
+        """
+        Draws counts for n and p broadcast to (..., y, x).
+        """
+        n, p = np.broadcast_arrays(n, p)
+
+        counts = np.stack([
+            self.streams.generator(self.purpose, self.generation, row, self.draws).binomial(n[..., r, :], p[..., r, :])
+            for r, row in enumerate(self.rows)
+        ], axis=-2)
+        self.draws += 1
+
+        return counts
@@ -0,0 +1,179 @@
+import numpy as np
+from scipy.signal import fftconvolve
+
+from genotype_registry import generate_genotype_registry
+
+# Spatial population-genetic statistics of the vectorized engine's grids, shaped (..., genotype, sex, height, width).
+# Any leading axes, e.g. the generations of GridHistory or replicates, are carried through, so a whole
+# history can be summarized in one call. Cells are the demes, and empty cells are left out.
+
+
+def calc_allele_frequency_grid(grid, genotypes):
+    """
+    The frequency of each allele within its locus in every cell, shaped (..., allele, height, width)
+    in the order of GenotypeRegistry.alleles, and 0 in empty cells.
+
+    """
+    registry = generate_genotype_registry(genotypes)
+
+    genotype_N = grid.sum(axis=-3)
+    N = genotype_N.sum(axis=-3)
+    allele_counts = np.einsum('...ghw,ga->...ahw', genotype_N, registry.allele_counts)
+
+    return allele_counts / np.where(N == 0, 1, 2 * N)[..., None, :, :]
+
+
+def calc_heterozygosity_grid(grid, genotypes):
+    """
+    Maps of the expected (1 - sum of squared allele frequencies) and observed (share of heterozygous loci)
+    heterozygosity of every cell, averaged over loci, each shaped (..., height, width) and 0 in empty cells.
+
+    """
+    registry = generate_genotype_registry(genotypes)
+    num_loci = registry.allele_loci.max(initial=0) + 1
+
+    genotype_N = grid.sum(axis=-3)
+    N = genotype_N.sum(axis=-3)
+    homozygosity = (calc_allele_frequency_grid(grid, genotypes) ** 2).sum(axis=-3) / num_loci
+    heterozygous = np.einsum('...ghw,g->...hw', genotype_N, registry.heterozygous_loci) / num_loci
+
+    expected = np.where(N > 0, 1 - homozygosity, 0)
+    observed = heterozygous / np.where(N == 0, 1, N)
+    return expected, observed
+
+
+def calc_global_Fst(grid, genotypes):
+    """
+    Fst of the whole map, (HT - HS) / HT, where HS is the population-weighted mean expected heterozygosity of
+    the cells and HT the expected heterozygosity of the pooled map. Returns an array of the leading axes' shape.
+
+    """
+    registry = generate_genotype_registry(genotypes)
+    num_loci = registry.allele_loci.max(initial=0) + 1
+
+    N = calc_N_cells(grid)
+    total_N = N.sum(axis=(-2, -1))
+    safe_total_N = np.where(total_N == 0, 1, total_N)
+    frequencies = calc_allele_frequency_grid(grid, genotypes)
+
+    HS = (calc_heterozygosity_grid(grid, genotypes)[0] * N).sum(axis=(-2, -1)) / safe_total_N
+    pooled_frequencies = (frequencies * N[..., None, :, :]).sum(axis=(-2, -1)) / safe_total_N[..., None]
+    HT = 1 - (pooled_frequencies ** 2).sum(axis=-1) / num_loci
+
+    return np.where(HT > 0, (HT - HS) / np.where(HT > 0, HT, 1), 0)
+
+
+def calc_pairwise_Fst(grid, genotypes, pairs):
+    """
+    Fst between pairs of cells, 1 - HS / HT with HS the mean expected heterozygosity of the two cells and
+    HT that of their mean allele frequencies.
+
+    Args:
+    - grid: Counts shaped (..., genotype, sex, height, width).
+    - genotypes: List of genotypes in the order of the genotype axis.
+    - pairs: Array of (y1, x1, y2, x2) rows, e.g. from sample_cell_pairs.
+
+    Returns:
+    - Array shaped (..., pair), NaN where a cell of the pair is empty.
+    """
+    registry = generate_genotype_registry(genotypes)
+    num_loci = registry.allele_loci.max(initial=0) + 1
+
+    pairs = np.asarray(pairs)
+    frequencies = calc_allele_frequency_grid(grid, genotypes)
+    frequencies_1 = frequencies[..., pairs[:, 0], pairs[:, 1]]
+    frequencies_2 = frequencies[..., pairs[:, 2], pairs[:, 3]]
+
+    HS = 1 - ((frequencies_1 ** 2).sum(axis=-2) + (frequencies_2 ** 2).sum(axis=-2)) / (2 * num_loci)
+    HT = 1 - (((frequencies_1 + frequencies_2) / 2) ** 2).sum(axis=-2) / num_loci
+
+    N = calc_N_cells(grid)
+    occupied = (N[..., pairs[:, 0], pairs[:, 1]] > 0) & (N[..., pairs[:, 2], pairs[:, 3]] > 0)
+    Fst = np.where(HT > 0, 1 - HS / np.where(HT > 0, HT, 1), 0)
+    return np.where(occupied, Fst, np.nan)
+
+
+def sample_cell_pairs(height, width, num_pairs, rng=None):
+    """
+    Draws num_pairs pairs of different cells uniformly at random, as (y1, x1, y2, x2) rows.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+
+    first = rng.integers(height * width, size=num_pairs)
+    second = (first + rng.integers(1, height * width, size=num_pairs)) % (height * width)
+    return np.stack([first // width, first % width, second // width, second % width], axis=-1)
+
+
+def calc_isolation_by_distance(grid, genotypes, max_distance=None, num_pairs=None, rng=None):
+    """
+    Fst between pairs of occupied cells by their grid (Manhattan) distance, as the ratio of the mean HT - HS
+    to the mean HT of all pairs at each distance.
+
+    By default every pair of cells is included, summed by FFT cross-correlation of the allele frequency maps
+    in O(A HW log HW) rather than over (HW)^2 pairs. If num_pairs is given, a random sample of that many pairs
+    is used instead (see sample_cell_pairs).
+
+    Returns:
+    - distances (D,), Fst (..., D) and the number of pairs at each distance (..., D), for distances 1 to max_distance
+      (by default the largest distance on the map). Fst is NaN where there are no pairs.
+    """
+    registry = generate_genotype_registry(genotypes)
+    num_loci = registry.allele_loci.max(initial=0) + 1
+    height, width = grid.shape[-2:]
+    max_distance = height + width - 2 if max_distance is None else max_distance
+
+    frequencies = calc_allele_frequency_grid(grid, genotypes)
+    occupied = (calc_N_cells(grid) > 0).astype(float)
+    homozygosity = (frequencies ** 2).sum(axis=-3) / num_loci
+
+    if num_pairs is None:
+        # Sums over all pairs at each displacement (dy, dx), by cross-correlation
+        pair_counts = _cross_correlate(occupied, occupied)
+        homozygosity_sums = 2 * _cross_correlate(homozygosity * occupied, occupied)
+        frequency_products = _cross_correlate(frequencies, frequencies).sum(axis=-3) / num_loci
+
+        dy = np.abs(np.arange(-(height - 1), height))
+        dx = np.abs(np.arange(-(width - 1), width))
+        pair_distances = (dy[:, None] + dx[None, :]).ravel()
+        pair_counts = np.round(pair_counts).reshape(pair_counts.shape[:-2] + (-1,))
+        homozygosity_sums = homozygosity_sums.reshape(pair_counts.shape)
+        frequency_products = frequency_products.reshape(pair_counts.shape)
+    else:
+        pairs = sample_cell_pairs(height, width, num_pairs, rng)
+        pair_distances = np.abs(pairs[:, 0] - pairs[:, 2]) + np.abs(pairs[:, 1] - pairs[:, 3])
+
+        frequencies_1 = frequencies[..., pairs[:, 0], pairs[:, 1]]
+        frequencies_2 = frequencies[..., pairs[:, 2], pairs[:, 3]]
+        pair_counts = occupied[..., pairs[:, 0], pairs[:, 1]] * occupied[..., pairs[:, 2], pairs[:, 3]]
+        homozygosity_sums = (homozygosity[..., pairs[:, 0], pairs[:, 1]] + homozygosity[..., pairs[:, 2], pairs[:, 3]]) * pair_counts
+        frequency_products = (frequencies_1 * frequencies_2).sum(axis=-2) / num_loci * pair_counts
+
+    # Sum HS and HT of the pairs at each distance
+    distances = np.arange(1, max_distance + 1)
+    in_range = (pair_distances >= 1) & (pair_distances <= max_distance)
+    bins = pair_distances[in_range] - 1
+
+    def sum_by_distance(values):
+        values = values[..., in_range]
+        sums = np.zeros(values.shape[:-1] + (max_distance,))
+        np.add.at(sums, (..., bins), values)
+        return sums
+
+    counts = sum_by_distance(pair_counts)
+    HS = counts - sum_by_distance(homozygosity_sums) / 2
+    HT = counts - (sum_by_distance(homozygosity_sums) + 2 * sum_by_distance(frequency_products)) / 4
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Fst = np.where(counts > 0, (HT - HS) / HT, np.nan)
+    return distances, Fst, counts
+
+
+def calc_N_cells(grid):
+    return grid.sum(axis=(-4, -3))
+
+
+def _cross_correlate(a, b):
+    """
+    Full 2d cross-correlation over the last two axes: out[dy, dx] = sum over cells of a[y, x] * b[y + dy, x + dx].
+    """
+    return fftconvolve(a[..., ::-1, ::-1], b, mode='full', axes=(-2, -1))
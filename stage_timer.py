@@ -0,0 +1,102 @@
+import json
+import time
+import contextlib
+
+# pandas is only needed for StageTimer.to_dataframe
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+
+class StageTimer:
+    """
+    Records the wall time and number of calls of each stage of each generation (gene flow, fitness, drift,
+    bottleneck, mating, mutation, history append, ...).
+
+    Engines time a stage with `with timer.stage('mating'):`. When timing is off they're given NULL_TIMER,
+    whose stage does nothing.
+
+    """
+    def __init__(self):
+        self.generation = None
+        self.records = {}
+
+    def start_generation(self, generation):
+        self.generation = generation
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def add(self, name, seconds, calls=1):
+        record = self.records.setdefault((self.generation, name), [0.0, 0])
+        record[0] += seconds
+        record[1] += calls
+
+    def report(self):
+        """
+        One {'generation', 'stage', 'seconds', 'calls'} dict per stage of each generation, in the order they first ran.
+        """
+        return [
+            {'generation': generation, 'stage': name, 'seconds': seconds, 'calls': calls}
+            for (generation, name), (seconds, calls) in self.records.items()
+        ]
+
+    def summary(self):
+        """
+        The total seconds and calls of each stage over all generations, as {stage: {'seconds', 'calls'}}.
+        """
+        totals = {}
+        for (_, name), (seconds, calls) in self.records.items():
+            total = totals.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            total['seconds'] += seconds
+            total['calls'] += calls
+        return totals
+
+    def write_json_lines(self, path):
+        """
+        Writes the report to path, one JSON object per line.
+        """
+        with open(path, 'w') as f:
+            for record in self.report():
+                f.write(json.dumps(record) + '\n')
+
+    def to_dataframe(self):
+        if pd is None:
+            raise ImportError("StageTimer.to_dataframe requires pandas.")
+        return pd.DataFrame(self.report(), columns=['generation', 'stage', 'seconds', 'calls'])
+
+
+class _Stage:
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.timer.add(self.name, time.perf_counter() - self.start)
+
+
+class _NullTimer:
+    """
+    A StageTimer that records nothing.
+    """
+    _stage = contextlib.nullcontext()
+
+    def start_generation(self, generation):
+        pass
+
+    def stage(self, name):
+        return self._stage
+
+
+NULL_TIMER = _NullTimer()
+
+
+def print_progress(generation, simulation):
+    """
+    The default progress callback, printing each generation as it finishes.
+    """
+    print(f"Generation {generation}")
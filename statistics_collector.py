@@ -0,0 +1,123 @@
+import numpy as np
+
+from genotype_registry import generate_genotype_registry
+from calc_Ne import calc_Ne_sex_ratios, calc_Ne_inbreeding
+
+# In the order of calc_Ne_over_generations
+NE_ESTIMATORS = ['Ne (Sex Ratios)', 'Ne (Size Variation)', 'Ne (Allele Variation)', 'Ne (Inbreeding)']
+
+# Per-generation series kept by the collector
+SERIES = ['N', 'Nm', 'Nf', 'allele_frequencies', 'expected_heterozygosity', 'observed_heterozygosity', 'harmonic_mean_N', 'Ne']
+
+class StatisticsCollector:
+    """
+    Collects population statistics live, one generation at a time.
+
+    Each update costs O(G) regardless of how many generations came before: the harmonic mean N behind
+    'Ne (Size Variation)' is kept as a running sum of 1/N instead of being recomputed from the whole history.
+    Allele frequencies and the four Ne estimators match calc_allele_frequencies and calc_Ne_over_generations
+    on the same generations.
+
+    Counts may carry leading axes (e.g. replicates), which every statistic keeps.
+
+    """
+    def __init__(self, genotypes):
+        self.registry = generate_genotype_registry(genotypes)
+        self.alleles = self.registry.alleles
+        self.Ne_estimators = NE_ESTIMATORS
+
+        self.generations = 0
+        self.reciprocal_N_sum = 0
+        self.series = {name: [] for name in SERIES}
+
+    def __len__(self):
+        return self.generations
+
+    def update(self, counts):
+        """
+        Records the statistics of one generation from its genotype counts, shaped (..., genotype, sex).
+        """
+        counts = np.asarray(counts, dtype=float)
+        Nm, Nf = counts[..., 0].sum(axis=-1), counts[..., 1].sum(axis=-1)
+        N = Nm + Nf
+        genotype_N = counts.sum(axis=-1)
+
+        self.generations += 1
+        t = self.generations
+        num_loci = self.registry.allele_loci.max(initial=0) + 1
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Frequencies over the alleles of all loci, as in calc_allele_frequencies
+            allele_counts = genotype_N @ self.registry.allele_counts
+            allele_frequencies = np.nan_to_num(allele_counts / allele_counts.sum(axis=-1, keepdims=True))
+
+            # Per locus, averaged over loci
+            locus_frequencies = allele_frequencies * num_loci
+            expected_heterozygosity = 1 - (locus_frequencies ** 2).sum(axis=-1) / num_loci
+            observed_heterozygosity = np.nan_to_num(genotype_N @ self.registry.heterozygous_loci / (N * num_loci))
+
+            self.reciprocal_N_sum = self.reciprocal_N_sum + 1.0 / N
+            harmonic_mean_N = t / self.reciprocal_N_sum
+
+            sigma = (allele_frequencies * (1 - allele_frequencies)).sum(axis=-1) * ((1 - (1 / (2 * N))) ** t)
+            Ne = np.stack([
+                calc_Ne_sex_ratios(Nm, Nf),
+                harmonic_mean_N,
+                np.where(sigma == 0, N, N * (1 - sigma)),
+                calc_Ne_inbreeding(N, t),
+            ], axis=-1)
+
+        for name, value in [('N', N),
+                            ('Nm', Nm),
+                            ('Nf', Nf),
+                            ('allele_frequencies', allele_frequencies),
+                            ('expected_heterozygosity', expected_heterozygosity),
+                            ('observed_heterozygosity', observed_heterozygosity),
+                            ('harmonic_mean_N', harmonic_mean_N),
+                            ('Ne', Ne)]:
+            self.series[name].append(value)
+
+    def update_genotype_data(self, genotype_data):
+        """
+        update from a genotype data dict.
+        """
+        self.update(self.registry.to_array(genotype_data))
+
+    def latest(self):
+        """
+        The statistics of the last recorded generation, e.g. to report progress during a run.
+        """
+        return {name: values[-1] for name, values in self.series.items()}
+
+    @property
+    def gens_Ne(self):
+        """
+        Ne per generation as a list of {estimator: Ne} dicts, like calc_Ne_over_generations.
+        """
+        return [dict(zip(self.Ne_estimators, Ne.tolist())) for Ne in self.series['Ne']]
+
+    @property
+    def gens_allele_frequencies(self):
+        """
+        Allele frequencies per generation as a list of {allele: frequency} dicts, like calc_allele_frequencies.
+        """
+        return [dict(zip(self.alleles, frequencies.tolist())) for frequencies in self.series['allele_frequencies']]
+
+    def to_arrays(self):
+        """
+        Every series stacked into an array with generations on the first axis, plus the running sums.
+        """
+        arrays = {name: np.array(values) for name, values in self.series.items()}
+        arrays['reciprocal_N_sum'] = np.asarray(self.reciprocal_N_sum, dtype=float)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, genotypes, arrays):
+        """
+        Restores a collector from to_arrays, e.g. from a checkpoint.
+        """
+        collector = cls(genotypes)
+        collector.series = {name: list(arrays[name]) for name in SERIES}
+        collector.generations = len(collector.series['N'])
+        collector.reciprocal_N_sum = arrays['reciprocal_N_sum'][()]
+        return collector
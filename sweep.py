@@ -0,0 +1,92 @@
+import random
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def run_sweep(model, param_grid, replicates=1, generations=100, base_params=None, seed=None, max_workers=None, **run_kwargs):
+    """
+    Runs every combination of parameters in param_grid, replicates times each, across a process pool.
+
+    Each job gets an independent random stream spawned from seed, constructs model() (TopographicalSpeciation
+    or PopGen), sets base_params and its combination of parameters as attributes, runs for the given generations
+    and only sends back a compact summary (see summarize), not the model itself.
+
+    Args:
+    - model: The simulation class, e.g. TopographicalSpeciation or PopGen.
+    - param_grid: Dict of attribute name to a list of values, e.g. {'growth_rate': [0.1, 1.1], 'max_drift': [0, 0.1]}.
+    - replicates: Number of runs per parameter combination.
+    - generations: Number of generations per run.
+    - base_params: Dict of attributes shared by all runs, e.g. width, height, N and K, or genotype_data.
+    - seed: Root seed of the sweep. Runs are reproducible given the seed, independently of max_workers.
+    - max_workers: Number of worker processes, defaults to the number of CPUs.
+    - run_kwargs: Passed on to run(), e.g. bottleneck_yr and bottleneck_N.
+
+    Returns:
+    - List of {'params', 'replicate', 'seed', 'summary'} dicts, in param_grid order.
+    """
+    names = list(param_grid.keys())
+    combinations = [dict(zip(names, values)) for values in itertools.product(*param_grid.values())]
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(combinations) * replicates)
+
+    runs, jobs = [], []
+    for i, params in enumerate(combinations):
+        for replicate in range(replicates):
+            job_seed = int(seed_sequences[i * replicates + replicate].generate_state(1)[0])
+            runs.append({'params': params, 'replicate': replicate, 'seed': job_seed})
+            jobs.append((model, {**(base_params or {}), **params}, generations, run_kwargs, job_seed))
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        summaries = list(executor.map(run_job, jobs))
+
+    return [{**run, 'summary': summary} for run, summary in zip(runs, summaries)]
+
+def run_job(job):
+    """
+    Runs a single sweep job in a worker process and returns its summary.
+    """
+    model, params, generations, run_kwargs, seed = job
+
+    # Each worker process has its own global random states, seeded per job
+    random.seed(seed)
+    np.random.seed(seed)
+
+    simulation = model()
+    simulation.seed = seed
+    # Keep per-generation progress output of hundreds of runs out of the parent's console
+    simulation.progress = None
+    for name, value in params.items():
+        setattr(simulation, name, value)
+
+    simulation.run(generations, **run_kwargs)
+
+    return summarize(simulation)
+
+def summarize(simulation):
+    """
+    Summarizes a finished TopographicalSpeciation (over the whole map, of the first replicate) or PopGen run
+    as arrays per generation, from the statistics collected during the run.
+
+    Returns:
+    - Dict with 'N', 'Nm' and 'Nf' (generation,), 'alleles' and 'allele_frequencies' (generation, allele),
+      'Ne_estimators' and 'Ne' (generation, estimator), 'stop_generation' and 'stop_reason' if the run
+      stopped early (otherwise None), and 'timing', the StageTimer summary if the run had a timer (otherwise None).
+    """
+    statistics = simulation.statistics
+    arrays = statistics.to_arrays()
+    if arrays['N'].ndim == 2:
+        arrays = {name: array[:, 0] for name, array in arrays.items() if array.ndim > 0}
+
+    return {
+        'N': arrays['N'],
+        'Nm': arrays['Nm'],
+        'Nf': arrays['Nf'],
+        'alleles': statistics.alleles,
+        'allele_frequencies': arrays['allele_frequencies'],
+        'Ne_estimators': statistics.Ne_estimators,
+        'Ne': arrays['Ne'],
+        'stop_generation': simulation.stop_generation,
+        'stop_reason': simulation.stop_reason,
+        'timing': simulation.timer.summary() if simulation.timer is not None else None,
+    }
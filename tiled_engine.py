@@ -0,0 +1,118 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from grid_engine import calc_next_grid, calc_gene_flow_grid
+from rng import RandomStreams
+
+# Arrays attached to shared memory in each worker process, by name
+_shared_arrays = {}
+
+
+class TiledEngine:
+    """
+    Runs the vectorized generation of one large map across worker processes.
+
+    The map is split into strips of tile_rows rows. The current and next grids and the static fields live in
+    multiprocessing.shared_memory, and each worker computes its strips from the current grid plus a halo of
+    max gene flow distance rows above and below, which is all the gene flow into the strip can come from.
+    The tiling doesn't depend on the number of workers and drift noise comes from one random stream per row
+    (see RandomStreams), so results are identical for any number of workers and to the single-process engine.
+
+    """
+    def __init__(self, grid, K, fitnesses, covariances, gene_flow_distances, workers=None, tile_rows=32, streams=None):
+        self.shape = grid.shape
+        self.seed = (streams or RandomStreams()).seed
+        self.halo = int(gene_flow_distances.max(initial=0))
+
+        height = grid.shape[-2]
+        self.tiles = [(y0, min(height, y0 + tile_rows)) for y0 in range(0, height, tile_rows)]
+
+        self.shared_memory = {}
+        self.specs = {}
+        for name, array in [('grid_0', grid),
+                            ('grid_1', grid),
+                            ('K', K),
+                            ('fitnesses', fitnesses),
+                            ('covariances', covariances),
+                            ('gene_flow_distances', gene_flow_distances)]:
+            array = np.asarray(array, dtype=float)
+            shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+            np.ndarray(array.shape, dtype=float, buffer=shm.buf)[...] = array
+
+            self.shared_memory[name] = shm
+            self.specs[name] = (shm.name, array.shape)
+
+        self.current = 0
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_attach_shared_arrays, initargs=(self.specs,))
+
+    @property
+    def grid(self):
+        """
+        A copy of the current grid.
+        """
+        shm = self.shared_memory[f'grid_{self.current}']
+        return np.ndarray(self.shape, dtype=float, buffer=shm.buf).copy()
+
+    def calc_generation(self, i, genotypes, growth_rate, max_drift, mutation_rate, bottleneck_N=None, factorized=False, drift_mode='uniform'):
+        """
+        Calculates generation i on every tile and returns the new grid.
+        """
+        settings = (i, genotypes, growth_rate, max_drift, mutation_rate, bottleneck_N, factorized, drift_mode, self.halo, self.seed)
+        tasks = [(y0, y1, f'grid_{self.current}', f'grid_{1 - self.current}', settings) for y0, y1 in self.tiles]
+
+        # Wait for all tiles before swapping, so no worker reads a half-written grid
+        list(self.executor.map(_calc_tile_generation, tasks))
+
+        self.current = 1 - self.current
+        return self.grid
+
+    def close(self):
+        self.executor.shutdown()
+        for shm in self.shared_memory.values():
+            shm.close()
+            shm.unlink()
+        self.shared_memory = {}
+
+
+def _attach_shared_arrays(specs):
+    for name, (shm_name, shape) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _shared_arrays[name] = (shm, np.ndarray(shape, dtype=float, buffer=shm.buf))
+
+
+def _calc_tile_generation(task):
+    y0, y1, src, dst, settings = task
+    i, genotypes, growth_rate, max_drift, mutation_rate, bottleneck_N, factorized, drift_mode, halo, seed = settings
+
+    grid = _shared_arrays[src][1]
+    K = _shared_arrays['K'][1]
+    height = grid.shape[-2]
+
+    # Apply gene flow to the tile and its halo, then keep the tile
+    h0, h1 = max(0, y0 - halo), min(height, y1 + halo)
+    tile = grid[..., h0:h1, :]
+    if halo > 0:
+        tile = calc_gene_flow_grid(tile, K[h0:h1], _shared_arrays['gene_flow_distances'][1][:, h0:h1])
+    tile = tile[..., y0 - h0:y1 - h0, :]
+
+    # Empty strips stay empty
+    if not tile.any():
+        _shared_arrays[dst][1][..., y0:y1, :] = 0
+        return
+
+    tile = calc_next_grid(tile,
+                          K[y0:y1],
+                          _shared_arrays['fitnesses'][1][:, y0:y1],
+                          _shared_arrays['covariances'][1][:, y0:y1],
+                          genotypes,
+                          growth_rate,
+                          max_drift,
+                          mutation_rate,
+                          bottleneck_N,
+                          factorized,
+                          RandomStreams(seed).row_streams('drift', i, range(y0, y1)),
+                          drift_mode)
+
+    _shared_arrays[dst][1][..., y0:y1, :] = tile
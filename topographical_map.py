@@ -1,10 +1,11 @@
+import os
+
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.ndimage import gaussian_filter
 
 
 class TopographicMap:
-    def __init__(self, width, height, name, smoothness=1.0, min_val=0, max_val=1, sum_val=None):
+    def __init__(self, width, height, name, smoothness=1.0, min_val=0, max_val=1, sum_val=None, map_data=None, rng=None):
         self.width = width
         self.height = height
         self.name = name
@@ -12,25 +13,16 @@ class TopographicMap:
         self.min_val = min_val
         self.max_val = max_val
         self.sum_val = sum_val
-        self.map_data = self.generate_random_topographical_map()
+        self.rng = rng if rng is not None else np.random
+        # A previously generated map (e.g. from a checkpoint) can be passed in instead of generating one
+        self.map_data = map_data if map_data is not None else self.generate_random_topographical_map()
 
     def generate_random_topographical_map(self):
         """
         Generate a random topographical map with a normal distribution and normalize to [min_val, max_val].
         """
-        map_data = np.random.normal(0.5, 0.2, (self.width, self.height))
-        map_data = gaussian_filter(map_data, self.smoothness * ((self.width + self.height) // 2))
-        map_data = (map_data - np.min(map_data)) / (np.max(map_data) - np.min(map_data))
-        map_data = map_data * (self.max_val - self.min_val) + self.min_val
-        
-        # Adjust values to sum up to sum_val if provided
-        if self.sum_val is not None:
-            current_sum = np.sum(map_data)
-            if current_sum != 0:
-                scaling_factor = self.sum_val / current_sum
-                map_data *= scaling_factor
-        
-        return map_data
+        map_data = generate_random_fields(self.width, self.height, self.smoothness, [self.rng])[0]
+        return scale_field(map_data, self.min_val, self.max_val, self.sum_val)
 
     def __getitem__(self, idx):
         """
@@ -55,6 +47,83 @@ class TopographicMap:
         plt.show()
 
 
+def generate_random_fields(width, height, smoothness, rngs, cache_path=None):
+    """
+    Generates one smoothed random field in [0, 1] per rng, shaped (len(rngs), width, height). All fields
+    are smoothed in one batch in the frequency domain (see smooth_fields).
+
+    If cache_path is given, the fields are read from that .npy file if it holds at least as many fields of
+    the same shape, and otherwise generated and written there, so runs with the same landscape share them.
+
+    """
+    if cache_path is not None and os.path.exists(cache_path):
+        fields = np.load(cache_path, mmap_mode='r')
+        if fields.shape[1:] == (width, height) and len(fields) >= len(rngs):
+            return np.array(fields[:len(rngs)])
+
+    fields = np.stack([rng.normal(0.5, 0.2, (width, height)) for rng in rngs])
+    fields = smooth_fields(fields, smoothness * ((width + height) // 2))
+
+    low = fields.min(axis=(-2, -1), keepdims=True)
+    high = fields.max(axis=(-2, -1), keepdims=True)
+    fields = (fields - low) / (high - low)
+
+    if cache_path is not None:
+        # Written next to the cache file first, so processes sharing the cache never read a partial file
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, fields)
+        os.replace(tmp_path, cache_path)
+
+    return fields
+
+def smooth_fields(fields, sigma, truncate=4.0):
+    """
+    Gaussian smoothing of the last two axes, equal to scipy.ndimage.gaussian_filter(field, sigma) of each field.
+
+    The reflected boundary of gaussian_filter makes each axis periodic over twice its length, so the filter
+    is a circular convolution with the (wrapped) truncated kernel, done by FFT in O(n log n) whatever sigma is.
+
+    """
+    if sigma <= 1e-15:
+        return fields
+
+    radius = int(truncate * sigma + 0.5)
+    offsets = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 / (sigma * sigma) * offsets ** 2)
+    kernel = kernel / kernel.sum()
+
+    for axis in (-2, -1):
+        n = fields.shape[axis]
+        wrapped_kernel = np.zeros(2 * n)
+        np.add.at(wrapped_kernel, offsets % (2 * n), kernel)
+
+        shape = [1] * fields.ndim
+        shape[axis] = n + 1
+        transfer = np.fft.rfft(wrapped_kernel).reshape(shape)
+
+        extended = np.concatenate([fields, np.flip(fields, axis=axis)], axis=axis)
+        smoothed = np.fft.irfft(np.fft.rfft(extended, axis=axis) * transfer, n=2 * n, axis=axis)
+        fields = np.take(smoothed, np.arange(n), axis=axis)
+
+    return fields
+
+def scale_field(map_data, min_val=0, max_val=1, sum_val=None):
+    """
+    Scales a field in [0, 1] to [min_val, max_val], then to sum up to sum_val if provided.
+    """
+    map_data = map_data * (max_val - min_val) + min_val
+        
+    # Adjust values to sum up to sum_val if provided
+    if sum_val is not None:
+        current_sum = np.sum(map_data)
+        if current_sum != 0:
+            scaling_factor = sum_val / current_sum
+            map_data *= scaling_factor
+        
+    return map_data
+
+
 # # Example Usage
 # width = 100
 # height = 100
@@ -1,10 +1,15 @@
+import os
 import itertools
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 
-from topographical_map import TopographicMap
+from topographical_map import TopographicMap, generate_random_fields, scale_field
+from raster_loader import load_raster
 from cell import Cell
+from genotype_registry import generate_genotype_registry
+from statistics_collector import StatisticsCollector
+from convergence_detector import ConvergenceDetector
 
 # popgen functions
 from calc_N import calc_N
@@ -14,11 +19,21 @@ from calc_N_sub import calc_N_sub
 from adj_by_fitness import adj_by_fitness
 from adj_by_drift import adj_by_drift
 from adj_by_mutation import adj_by_mutation
+from adj_by_wright_fisher import adj_by_wright_fisher
 
 from calc_next_genotypes_data import calc_next_genotypes_data
 
 from append_cells import append_cells, append_gene_flow_cells
 
+from grid_engine import cells_to_grid, calc_next_grid, calc_gene_flow_grid, calc_active_cells, calc_active_window, DRIFT_MODES
+from dispersal_operators import generate_dispersal_operators, calc_dispersal_nonzeros, calc_gene_flow_sparse
+from grid_history import GridHistory
+from checkpoint import write_checkpoint, read_checkpoint
+from tiled_engine import TiledEngine
+from fused_kernel import calc_next_grid_fused
+from rng import RandomStreams
+from stage_timer import NULL_TIMER, print_progress
+
 from animator import Animator
 
 class TopographicalSpeciation:
@@ -47,49 +62,217 @@ class TopographicalSpeciation:
         self.max_drift = 0
         self.max_gene_flow_distance = 0
         self.mutation_rate = None
+        # 'uniform' drift up to max_drift, or 'wright_fisher' to resample each cell's offspring (ignores max_drift)
+        self.drift_mode = 'uniform'
+
+        # Mate locus by locus, assuming independent segregation (requires zero covariance)
+        self.factorized_mating = False
 
         self.generations = 0
 
+        # Stop a run early on extinction, fixation or equilibrium, see ConvergenceDetector. The generation and reason
+        # of the stop are kept in stop_generation and stop_reason
+        self.stop_early = False
+        self.convergence_tolerance = 1e-4
+        self.convergence_patience = 10
+        self.stop_on_fixation = True
+        self.convergence = None
+        self.stop_generation = None
+        self.stop_reason = None
+
+        # Optional StageTimer recording the time of each stage of every generation; None skips timing
+        self.timer = None
+        # Called with (generation, simulation) after each generation, e.g. to report progress; None to run silently
+        self.progress = print_progress
+
+        # Seed of all random draws of a run (maps, drift); None draws one from np.random
+        self.seed = None
+        self.streams = None
+        # Seed of the topographical maps alone, e.g. to share one landscape across a sweep; None uses seed
+        self.landscape_seed = None
+        # Optional directory caching the maps' random fields by width, height, smoothness and seed
+        self.field_cache_dir = None
+        # Optional elevation raster (.npy, ASCII grid or GeoTIFF) resampled to the map, to build maps from real terrain
+        # through transfer functions of the (height, width) elevation in place of random fields: the share of K of
+        # each cell (scaled to sum to K), and the fitness or gene flow distance of a genotype, fn(elevation, genotype)
+        self.raster_path = None
+        self.raster_block_rows = 1024
+        self.carrying_capacity_transfer = None
+        self.fitness_transfer = None
+        self.gene_flow_transfer = None
+
+        # Run each generation as whole-array operations over the map instead of per cell
+        self.vectorized = False
+        # Precompute sparse dispersal operators for the vectorized gene flow instead of convolving every generation.
+        # They hold about (2d + 1)^2 nonzeros per cell and genotype, so above sparse_gene_flow_max_nonzeros in total
+        # (about 12 bytes each) gene flow convolves instead. The tiled engine (workers) always convolves its strips,
+        # so no operators are built for it
+        self.sparse_gene_flow = True
+        self.sparse_gene_flow_max_nonzeros = 50_000_000
+        # Run the per-cell steps of the vectorized engine as one compiled pass with Numba, if it's installed
+        self.fused_kernel = False
+        self.fused_buffer = None
+        # Only compute the cells with individuals (after gene flow), within the bounding box of active_cells
+        # for the vectorized engine. Empty cells stay empty, so results are unchanged
+        self.active_cells_only = True
+        self.active_cells = None
+        # dtype of the vectorized engine's history store, e.g. np.float32 or np.int32
+        self.history_dtype = np.float32
+        # Optional .npy file to stream the vectorized history to, recording every history_stride-th generation
+        self.history_path = None
+        self.history_stride = 1
+        # Write a checkpoint to checkpoint_path every checkpoint_every generations (vectorized engine only)
+        self.checkpoint_path = None
+        self.checkpoint_every = None
+        # Number of stochastic replicates of the same landscape carried by the vectorized engine as a leading
+        # (replicate, genotype, sex, y, x) axis; None for a single run without the axis
+        self.replicates = None
+
+        # Split the vectorized map into strips of tile_rows rows computed by this many worker processes
+        self.workers = None
+        self.tile_rows = 32
+        self.tiled_engine = None
+
         self.animator = Animator()
 
     def generate_fields(self):
         if self.width is None or self.height is None or self.N is None or self.K is None:
             raise ValueError("Width, height, N, and K must be set before generating fields.")
-        
+
+        self.streams = RandomStreams(self.seed)
+        self.landscape_streams = self.streams if self.landscape_seed is None else RandomStreams(self.landscape_seed)
+        self.elevation = load_raster(self.raster_path, self.height, self.width, self.raster_block_rows) if self.raster_path else None
+
+        if self.carrying_capacity_transfer is not None:
+            carrying_capacity = scale_field(self.generate_raster_field(self.carrying_capacity_transfer), 0, 1, self.K)
+        else:
+            carrying_capacity = scale_field(self.generate_random_fields('carrying_capacity', 1)[0], self.min_cell_K, 1, self.K)
         self.topographical_carrying_capacity = TopographicMap(self.width,
                                                               self.height,
                                                               'Carrying Capacity',
                                                               self.smoothness,
                                                               min_val=self.min_cell_K,
-                                                              sum_val=self.K)
+                                                              sum_val=self.K,
+                                                              map_data=carrying_capacity)
         self.genotypes = self.generate_genotypes(self.alleles, self.loci)
+        self.registry = generate_genotype_registry(self.genotypes)
         self.cells = self.generate_cells()
 
-        self.topographical_fitnesses = self.generate_topographical_map_for_genotype()
-        self.topographical_gene_flow_distance = self.generate_topographical_map_for_genotype(max_val=self.max_gene_flow_distance)
+        self.topographical_fitnesses = self.generate_topographical_map_for_genotype('fitness', transfer=self.fitness_transfer)
+        self.topographical_gene_flow_distance = self.generate_topographical_map_for_genotype('gene_flow_distance',
+                                                                                             max_val=self.max_gene_flow_distance,
+                                                                                             transfer=self.gene_flow_transfer)
+
+        if self.vectorized:
+            self.generate_grids()
+
+        # Running statistics of the whole map, one entry per recorded generation
+        self.statistics = StatisticsCollector(self.registry)
+        self.update_statistics()
+
+        self.stop_generation = self.stop_reason = None
+        self.convergence = self.generate_convergence_detector()
+        if self.convergence is not None:
+            self.convergence.update(self.current_grid())
+
+    def generate_grids(self):
+        """
+        Stacks the cells and topographical maps into dense arrays for the vectorized engine.
+
+        """
+        self.generate_grid_fields()
+
+        self.grid, self.grid_covariances = cells_to_grid(self.cells, self.genotypes)
+        if self.replicates:
+            self.grid = np.repeat(self.grid[None], self.replicates, axis=0)
+        self.history = GridHistory(self.grid,
+                                   self.genotypes,
+                                   self.grid_covariances,
+                                   self.grid_carrying_capacity,
+                                   dtype=self.history_dtype,
+                                   path=self.history_path,
+                                   stride=self.history_stride)
+        self.attach_history()
+
+    def generate_grid_fields(self):
+        """
+        Stacks the topographical maps into arrays. Fitness and gene flow maps are transposed to match
+        the [x][y] indexing of the per-cell path.
+
+        """
+        self.grid_carrying_capacity = np.asarray(self.topographical_carrying_capacity.map_data)
+        self.grid_fitnesses = np.stack([self.topographical_fitnesses[genotype].map_data.T for genotype in self.genotypes])
+        self.grid_gene_flow_distance = np.stack([self.topographical_gene_flow_distance[genotype].map_data.T for genotype in self.genotypes])
+
+        self.dispersal_operators = None
+        if (self.sparse_gene_flow and self.max_gene_flow_distance > 0 and not self.workers
+                and calc_dispersal_nonzeros(self.grid_gene_flow_distance) <= self.sparse_gene_flow_max_nonzeros):
+            self.dispersal_operators = generate_dispersal_operators(self.grid_gene_flow_distance)
+
+    def attach_history(self, replicate=0):
+        """
+        Makes the cells read their history from the store, from the given replicate if there are replicates.
+
+        """
+        for y in range(self.height):
+            for x in range(self.width):
+                self.cells[y][x].gens_genotype_data = self.history.cell_view(y, x, replicate)
 
     def generate_cells(self):
         cells = [[None for _ in range(self.width)] for _ in range(self.height)]
 
         cell_N = self.N / (self.width * self.height)
+        rng = self.streams.generator('cells')
         for x in range(self.width):
             for y in range(self.height):
                 carrying_capacity = self.topographical_carrying_capacity[y][x]
-                cells[y][x] = Cell(x, y, cell_N/2, cell_N/2, self.genotypes, carrying_capacity)
+                cells[y][x] = Cell(x, y, cell_N/2, cell_N/2, self.registry, carrying_capacity, rng)
 
         return cells
     
-    def generate_topographical_map_for_genotype(self, min_val=0, max_val=1, sum_val=None):
+    def generate_topographical_map_for_genotype(self, purpose, min_val=0, max_val=1, sum_val=None, transfer=None):
+        if transfer is not None:
+            # Transposed to the [x][y] indexing of the genotype maps, and used as they are
+            fields = [self.generate_raster_field(transfer, genotype).T for genotype in self.genotypes]
+        else:
+            fields = [scale_field(field, min_val, max_val, sum_val) for field in self.generate_random_fields(purpose, len(self.genotypes))]
+
         topographical_maps = {}
-        for genotype in self.genotypes:
+        for genotype, field in zip(self.genotypes, fields):
             topographical_maps[genotype] = TopographicMap(self.width,
                                                           self.height,
                                                           genotype,
                                                           self.smoothness,
                                                           min_val=min_val,
                                                           max_val=max_val,
-                                                          sum_val=sum_val)
+                                                          sum_val=sum_val,
+                                                          map_data=field)
         return topographical_maps
+
+    def generate_raster_field(self, transfer, *args):
+        """
+        Applies a transfer function to the elevation raster, shaped (height, width). No-data cells become 0.
+
+        """
+        if self.elevation is None:
+            raise ValueError("raster_path must be set to build maps with transfer functions.")
+
+        return np.nan_to_num(np.asarray(transfer(self.elevation, *args), dtype=float))
+
+    def generate_random_fields(self, purpose, count):
+        """
+        Generates the random fields behind count maps of one purpose as one batch, or reads them from field_cache_dir.
+
+        """
+        rngs = [self.landscape_streams.generator(purpose, index=i) for i in range(count)]
+
+        cache_path = None
+        if self.field_cache_dir is not None:
+            os.makedirs(self.field_cache_dir, exist_ok=True)
+            cache_path = os.path.join(self.field_cache_dir,
+                                      f'{purpose}_{self.width}x{self.height}_smoothness{self.smoothness}_seed{self.landscape_streams.seed}.npy')
+
+        return generate_random_fields(self.width, self.height, self.smoothness, rngs, cache_path)
     
     def generate_genotypes(self, alleles, loci):
 
@@ -104,23 +287,83 @@ class TopographicalSpeciation:
         return list(itertools.product(*all_locus_combinations))
     
     def run(self, generations, bottleneck_yr=None, bottleneck_N=None):
+        # Fail before any generation is computed rather than when the first checkpoint is due
+        if self.checkpoint_path and self.checkpoint_every and not self.vectorized:
+            raise ValueError("Checkpoints require the vectorized engine.")
+
         self.generate_fields()
 
         self.generations += generations
 
-        for i in range(generations):
-            print(f"Generation {i}")
-            self.calc_generation(i, bottleneck_yr, bottleneck_N)
+        if self.vectorized:
+            self.history.reserve(len(self.history) + -(-generations // self.history_stride))
+
+        return self.run_generations(0, generations, bottleneck_yr, bottleneck_N)
+
+    def resume(self, path):
+        """
+        Restores a run from a checkpoint written during run() and continues it to its last generation.
+
+        """
+        start, generations, bottleneck_yr, bottleneck_N = read_checkpoint(self, path)
+        return self.run_generations(start, generations, bottleneck_yr, bottleneck_N)
+
+    def run_generations(self, start, generations, bottleneck_yr=None, bottleneck_N=None):
+        if self.vectorized and self.workers:
+            self.tiled_engine = TiledEngine(self.grid,
+                                            self.grid_carrying_capacity,
+                                            self.grid_fitnesses,
+                                            self.grid_covariances,
+                                            self.grid_gene_flow_distance if self.max_gene_flow_distance > 0 else np.zeros_like(self.grid_fitnesses),
+                                            self.workers,
+                                            self.tile_rows,
+                                            self.streams)
+        self.active_cells = None
+        timer = self.timer or NULL_TIMER
+        try:
+            for i in range(start, generations):
+                timer.start_generation(i)
+                self.calc_generation(i, bottleneck_yr, bottleneck_N)
+
+                if self.progress is not None:
+                    self.progress(i, self)
+
+                if self.convergence is not None:
+                    with timer.stage('convergence'):
+                        converged = self.convergence.update(self.current_grid())
+                    if converged:
+                        self.stop_generation, self.stop_reason = i, self.convergence.reason
+                        self.generations -= generations - (i + 1)
+                        break
+
+                if self.checkpoint_path and self.checkpoint_every and (i + 1) % self.checkpoint_every == 0:
+                    with timer.stage('checkpoint'):
+                        write_checkpoint(self, self.checkpoint_path, i + 1, generations, bottleneck_yr, bottleneck_N)
+        finally:
+            if self.tiled_engine:
+                self.tiled_engine.close()
+                self.tiled_engine = None
+
+        if self.vectorized:
+            self.history.flush()
         
         return self.cells
 
     def calc_generation(self, i, bottleneck_yr=None, bottleneck_N=None):
+        timer = self.timer or NULL_TIMER
+        if self.vectorized:
+            self.calc_grid_generation(i, bottleneck_yr, bottleneck_N)
+            return self.update_statistics()
+
+        if self.drift_mode not in DRIFT_MODES:
+            raise ValueError(f"drift_mode must be one of {DRIFT_MODES}.")
 
         # Initialize the next generation, apply gene flow
-        if self.max_gene_flow_distance > 0:
-            self.cells = append_gene_flow_cells(self.cells, self.topographical_gene_flow_distance)
-        else:
-            self.cells = append_cells(self.cells) 
+        with timer.stage('gene_flow'):
+            if self.max_gene_flow_distance > 0:
+                self.cells = append_gene_flow_cells(self.cells, self.topographical_gene_flow_distance)
+            else:
+                self.cells = append_cells(self.cells) 
 
         # For each cell in the map
         for x in range(self.width):
@@ -128,40 +371,186 @@ class TopographicalSpeciation:
                 cell = self.cells[y][x]
 
                 curr_genotypes_data = cell.gens_genotype_data[-1]
+                if self.active_cells_only and calc_N(curr_genotypes_data) == 0:
+                    continue
+                rng = self.streams.generator('drift', i, y * self.width + x)
 
                 # next_N = min(calc_N(curr_genotypes_data), cell.carrying_capacity)
-                next_N = calc_next_N(calc_N(curr_genotypes_data), self.growth_rate, cell.carrying_capacity)
+                with timer.stage('growth'):
+                    next_N = calc_next_N(calc_N(curr_genotypes_data), self.growth_rate, cell.carrying_capacity)
 
 
                 # Apply evolutionary forces to genotypes in the current generation
-                curr_genotypes_data = adj_by_fitness(curr_genotypes_data, self.topographical_fitnesses, x, y)
-                curr_genotypes_data = adj_by_drift(curr_genotypes_data, self.max_drift, calc_N(curr_genotypes_data), cell.carrying_capacity)
+                with timer.stage('fitness'):
+                    curr_genotypes_data = adj_by_fitness(curr_genotypes_data, self.topographical_fitnesses, x, y)
+                if self.drift_mode == 'uniform':
+                    with timer.stage('drift'):
+                        curr_genotypes_data = adj_by_drift(curr_genotypes_data, self.max_drift, calc_N(curr_genotypes_data), cell.carrying_capacity, rng)
 
                 # If bottleneck, adjust population size, apply drift
                 if bottleneck_yr == i and next_N > bottleneck_N:
-                    curr_genotypes_data = adj_by_drift(curr_genotypes_data, 1-bottleneck_N/next_N, bottleneck_N, cell.carrying_capacity)
-                    next_N = bottleneck_N
+                    with timer.stage('bottleneck'):
+                        if self.drift_mode == 'uniform':
+                            curr_genotypes_data = adj_by_drift(curr_genotypes_data, 1-bottleneck_N/next_N, bottleneck_N, cell.carrying_capacity, rng)
+                        next_N = bottleneck_N
 
                 # Calculate the next generation
-                curr_genotypes_data = calc_next_genotypes_data(curr_genotypes_data, next_N * self.growth_rate)
-                curr_genotypes_data = adj_by_mutation(curr_genotypes_data, self.mutation_rate)
+                with timer.stage('mating'):
+                    curr_genotypes_data = calc_next_genotypes_data(curr_genotypes_data, next_N * self.growth_rate, self.factorized_mating)
+                with timer.stage('mutation'):
+                    curr_genotypes_data = adj_by_mutation(curr_genotypes_data, self.mutation_rate)
+                if self.drift_mode == 'wright_fisher':
+                    with timer.stage('drift'):
+                        curr_genotypes_data = adj_by_wright_fisher(curr_genotypes_data, cell.carrying_capacity, rng)
 
                 # Update the current cell's last genotypes data
                 cell.gens_genotype_data[-1] = curr_genotypes_data
 
+        self.update_statistics()
+
+    def update_statistics(self):
+        """
+        Adds the latest generation, summed over the map, to the running statistics.
+
+        """
+        with (self.timer or NULL_TIMER).stage('statistics'):
+            self.statistics.update(self.current_grid().sum(axis=(-2, -1)))
+
+    def current_grid(self):
+        """
+        The counts of the latest generation, shaped ([replicate,] genotype, sex, height, width).
+
+        """
+        return self.grid if self.vectorized else cells_to_grid(self.cells, self.genotypes)[0]
+
+    def generate_convergence_detector(self):
+        if not self.stop_early:
+            return None
+        return ConvergenceDetector(self.registry, self.convergence_tolerance, self.convergence_patience, self.stop_on_fixation)
+
+    def calc_grid_generation(self, i, bottleneck_yr=None, bottleneck_N=None):
+        """
+        Vectorized calc_generation, applying each step to every cell of the map at once.
+
+        """
+        K = self.grid_carrying_capacity
+        timer = self.timer or NULL_TIMER
+
+        if self.tiled_engine:
+            # Workers run every step of their tiles, so tiles are timed as a whole
+            with timer.stage('tiles'):
+                self.grid = self.tiled_engine.calc_generation(i,
+                                                              self.genotypes,
+                                                              self.growth_rate,
+                                                              self.max_drift,
+                                                              self.mutation_rate,
+                                                              bottleneck_N if bottleneck_yr == i else None,
+                                                              self.factorized_mating,
+                                                              self.drift_mode)
+            with timer.stage('history'):
+                self.history.append(self.grid)
+            return
+
+        # Initialize the next generation, apply gene flow
+        grid = self.grid
+        with timer.stage('gene_flow'):
+            if self.max_gene_flow_distance > 0 and self.dispersal_operators is not None:
+                grid = calc_gene_flow_sparse(grid, K, self.dispersal_operators)
+            elif self.max_gene_flow_distance > 0:
+                grid = calc_gene_flow_grid(grid, K, self.grid_gene_flow_distance)
+
+        window = (0, self.height, 0, self.width)
+        if self.active_cells_only:
+            with timer.stage('active_cells'):
+                if self.active_cells is None or self.max_gene_flow_distance > 0:
+                    # Migrants may have colonized empty cells, otherwise the mask of the last generation still holds
+                    self.active_cells = calc_active_cells(grid)
+                window = calc_active_window(self.active_cells)
+
+        if window is None:
+            grid = np.zeros_like(grid)
+        elif window == (0, self.height, 0, self.width):
+            grid = self.calc_grid_window(i, grid, window, bottleneck_yr, bottleneck_N, out=self.fused_buffer)
+            if self.fused_kernel:
+                # The fused kernel wrote into the grid from two generations ago, keep the current grid as the next buffer
+                self.fused_buffer = self.grid
+        else:
+            y0, y1, x0, x1 = window
+            next_grid = np.zeros_like(grid)
+            next_grid[..., y0:y1, x0:x1] = self.calc_grid_window(i, grid[..., y0:y1, x0:x1], window, bottleneck_yr, bottleneck_N)
+            grid = next_grid
+
+        if self.active_cells_only:
+            with timer.stage('active_cells'):
+                self.active_cells = np.zeros((self.height, self.width), dtype=bool)
+                if window is not None:
+                    y0, y1, x0, x1 = window
+                    self.active_cells[y0:y1, x0:x1] = calc_active_cells(grid[..., y0:y1, x0:x1])
+
+        self.grid = grid
+        with timer.stage('history'):
+            self.history.append(grid)
+
+    def calc_grid_window(self, i, grid, window, bottleneck_yr=None, bottleneck_N=None, out=None):
+        """
+        Applies the per-cell steps of generation i to the (y0, y1, x0, x1) window of the map that grid holds.
+
+        """
+        y0, y1, x0, x1 = window
+        rng = self.streams.row_streams('drift', i, range(y0, y1), slice(x0, x1), self.width)
+        fields = (self.grid_carrying_capacity[y0:y1, x0:x1],
+                  self.grid_fitnesses[:, y0:y1, x0:x1],
+                  self.grid_covariances[:, y0:y1, x0:x1],
+                  self.genotypes,
+                  self.growth_rate,
+                  self.max_drift,
+                  self.mutation_rate,
+                  bottleneck_N if bottleneck_yr == i else None,
+                  self.factorized_mating,
+                  rng,
+                  self.drift_mode)
+
+        if self.fused_kernel:
+            return calc_next_grid_fused(grid, *fields, out=out, timer=self.timer or NULL_TIMER)
+        return calc_next_grid(grid, *fields, timer=self.timer or NULL_TIMER)
+
 
     def animate_gens_genotypes(self, genotypes=None):
         if not genotypes:
             genotypes = self.genotypes
 
-        self.animator.animate_gens_genotypes(genotypes, self.cells, self.width, self.height, self.generations)
+        self.animator.animate_gens_genotypes(genotypes, self.cells, self.width, self.height, self.recorded_frames(), self.recorded_generations())
+
+    def export_gens_genotypes(self, path, genotypes=None, fps=4, dpi=100):
+        if not genotypes:
+            genotypes = self.genotypes
+
+        self.animator.export_gens_genotypes(path, genotypes, self.cells, self.width, self.height, self.recorded_frames(), fps, dpi, self.recorded_generations())
     
 
     def animate_gens_genotype_prevalence(self, genotypes=None, gradient=True):
         if not genotypes:
             genotypes = self.genotypes
         
-        self.animator.animate_gens_genotype_prevalence(genotypes, self.cells, self.width, self.height, self.generations, gradient)
+        self.animator.animate_gens_genotype_prevalence(genotypes, self.cells, self.width, self.height, self.recorded_frames(), gradient, self.recorded_generations())
+
+    def export_gens_genotype_prevalence(self, path, genotypes=None, gradient=True, fps=4, dpi=100):
+        if not genotypes:
+            genotypes = self.genotypes
+
+        self.animator.export_gens_genotype_prevalence(path, genotypes, self.cells, self.width, self.height, self.recorded_frames(), gradient, fps, dpi, self.recorded_generations())
+
+    def recorded_frames(self):
+        """
+        The number of generations that can be animated; the vectorized history may record only every k-th generation.
+        """
+        return len(self.history) if self.vectorized else self.generations
+
+    def recorded_generations(self):
+        """
+        The generation number of each animated frame.
+        """
+        return self.history.recorded_generations if self.vectorized else np.arange(self.generations)
 
 
 